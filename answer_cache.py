@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from chunk_store import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+COMPARE_ANSWER_FILE = os.path.join(DATA_DIR, "compare_answer.json")
+
+
+def load_precomputed_answer(kb_version: str | None, question: str,
+                            path: str = COMPARE_ANSWER_FILE) -> str | None:
+    """
+    Возвращает сохраненный ответ на `question`, если он был сгенерирован
+    для той же версии базы знаний. Иначе (или при ошибке чтения) — None.
+    """
+    if kb_version is None:
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать сохраненный ответ {path}: {e}")
+        return None
+    if data.get("kb_version") != kb_version or data.get("question") != question:
+        return None
+    return data.get("answer")
+
+
+def save_precomputed_answer(kb_version: str | None, question: str, answer: str,
+                            path: str = COMPARE_ANSWER_FILE) -> None:
+    """Атомарно сохраняет ответ рядом с базой знаний, привязывая его к ее версии."""
+    if kb_version is None:
+        return
+    data = {"kb_version": kb_version, "question": question, "answer": answer, "created_at": time.time()}
+    # Имя временного файла уникально для процесса: в режиме webhook ответ могут сохранять несколько процессов
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить ответ в {path}: {e}")
+
+
+SEMANTIC_CACHE_PATH = os.path.join(DATA_DIR, "semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Минимальное косинусное сходство вопросов для повторного ответа
+SEMANTIC_CACHE_MAX_SIZE = 500
+SEMANTIC_CACHE_TTL = 7 * 24 * 3600  # Время жизни ответа, с
+# Изменения кэша накапливаются и записываются на диск не чаще, чем раз в столько секунд
+SEMANTIC_CACHE_SAVE_DELAY = 5
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов на похожие вопросы.
+
+    Вопросы сравниваются по косинусному сходству их эмбеддингов (тех же,
+    что используются для поиска по базе знаний). Записи вытесняются по LRU
+    при превышении `max_size` и устаревают через `ttl` секунд. Кэш хранится
+    на диске (`<path>.json` — вопросы и ответы, `<path>.npy` — эмбеддинги)
+    и сбрасывается, если сохранен для другой версии базы знаний. Внутри
+    event loop изменения записываются в фоне (см. schedule_save).
+    """
+
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, kb_version: str | None = None,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_size: int = SEMANTIC_CACHE_MAX_SIZE, ttl: float = SEMANTIC_CACHE_TTL):
+        self.meta_file = f"{path}.json"
+        self.vectors_file = f"{path}.npy"
+        self.kb_version = kb_version
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Порядок записей — от давно использованных к недавно использованным
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._matrix: np.ndarray | None = None
+        self._matrix_keys: list[str] = []
+        self._dirty = False
+        self._save_task: asyncio.Task | None = None
+        # Фоновая запись и flush при остановке не должны писать файлы одновременно
+        self._write_lock = threading.Lock()
+        self._load()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype='float32').ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self) -> None:
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry["created_at"] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _similarity_matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = np.stack([self._entries[key]["embedding"] for key in self._matrix_keys])
+        return self._matrix
+
+    def lookup(self, embedding: np.ndarray) -> str | None:
+        """Возвращает сохраненный ответ на самый похожий вопрос, если сходство не ниже порога."""
+        self._expire()
+        if self._entries:
+            scores = self._similarity_matrix() @ self._normalize(embedding)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key = self._matrix_keys[best]
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]["answer"]
+        self.misses += 1
+        return None
+
+    def put(self, question: str, embedding: np.ndarray, answer: str) -> None:
+        """Сохраняет ответ на вопрос, вытесняя давно не использованные записи."""
+        key = hashlib.sha256(question.strip().lower().encode('utf-8')).hexdigest()
+        self._entries.pop(key, None)
+        self._entries[key] = {
+            "question": question,
+            "answer": answer,
+            "embedding": self._normalize(embedding),
+            "created_at": time.time(),
+        }
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._matrix = None
+        self.schedule_save()
+
+    def invalidate(self, kb_version: str | None) -> None:
+        """Сбрасывает кэш при смене версии базы знаний."""
+        self.kb_version = kb_version
+        self._entries.clear()
+        self._matrix = None
+        self.schedule_save()
+
+    def _load(self) -> None:
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            vectors = np.load(self.vectors_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось загрузить кэш ответов: {e}")
+            return
+        entries = meta.get("entries", [])
+        if meta.get("kb_version") != self.kb_version or len(entries) != len(vectors):
+            logger.info("Кэш ответов создан для другой версии базы знаний и будет сброшен.")
+            return
+        for entry, vector in zip(entries, vectors):
+            self._entries[entry["key"]] = {
+                "question": entry["question"],
+                "answer": entry["answer"],
+                "embedding": vector,
+                "created_at": entry["created_at"],
+            }
+        self._expire()
+
+    def schedule_save(self) -> None:
+        """
+        Сохраняет кэш, не блокируя event loop: изменения за SEMANTIC_CACHE_SAVE_DELAY
+        секунд записываются одним разом в отдельном потоке. Вне event loop
+        кэш сохраняется сразу.
+        """
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_in_background())
+
+    async def _save_in_background(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(SEMANTIC_CACHE_SAVE_DELAY)
+            self._dirty = False
+            # Снимок берется в event loop, в потоке только пишутся файлы
+            await asyncio.to_thread(self._write, *self._snapshot())
+
+    def flush(self) -> None:
+        """Сразу записывает несохраненные изменения (при остановке бота)."""
+        if self._save_task is not None:
+            self._save_task.cancel()
+            self._save_task = None
+        if self._dirty:
+            self.save()
+
+    def save(self) -> None:
+        """Атомарно сохраняет кэш на диск."""
+        self._dirty = False
+        self._write(*self._snapshot())
+
+    def _snapshot(self) -> tuple[dict, np.ndarray]:
+        keys = list(self._entries)
+        meta = {
+            "kb_version": self.kb_version,
+            "entries": [
+                {"key": key, "question": self._entries[key]["question"],
+                 "answer": self._entries[key]["answer"], "created_at": self._entries[key]["created_at"]}
+                for key in keys
+            ],
+        }
+        vectors = (np.stack([self._entries[key]["embedding"] for key in keys])
+                   if keys else np.zeros((0, 0), dtype='float32'))
+        return meta, vectors
+
+    def _write(self, meta: dict, vectors: np.ndarray) -> None:
+        try:
+            with self._write_lock:
+                with open(f"{self.vectors_file}.tmp", 'wb') as f:
+                    np.save(f, vectors)
+                with open(f"{self.meta_file}.tmp", 'w', encoding='utf-8') as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                os.replace(f"{self.vectors_file}.tmp", self.vectors_file)
+                os.replace(f"{self.meta_file}.tmp", self.meta_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш ответов: {e}")
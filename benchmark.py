@@ -0,0 +1,429 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+from aiohttp import web
+
+from chunk_store import CHUNK_STORE_FILE, ChunkStore, chunk_faiss_id
+from knowledge_base import (
+    BM25_INDEX_FILE,
+    DATA_DIR,
+    DEFAULT_INDEX_SPEC,
+    FAISS_INDEX_FILE,
+    INDEX_META_FILE,
+    build_index,
+    save_index,
+)
+from lexical_index import BM25Index
+
+# Настройки поддельного Ollama
+FAKE_OLLAMA_HOST = "127.0.0.1"
+FAKE_OLLAMA_PORT = 11500
+EMBEDDING_DIM = 768
+EMBED_LATENCY = 0.02  # Задержка ответа на запрос эмбеддинга, с
+PREFILL_LATENCY = 0.3  # Обработка промпта перед первым токеном, с
+TOKEN_LATENCY = 0.01  # Интервал между токенами ответа, с
+ANSWER_TOKENS = 120
+
+# Настройки симуляции Telegram и диалогов
+TELEGRAM_LATENCY = 0.05  # Задержка одного вызова Bot API, с
+CONVERSATIONS = 20
+QUESTIONS_PER_CONVERSATION = 5
+COMPARE_SHARE = 0.1  # Доля нажатий "Сравнить программы" среди запросов
+SEARCH_QUERIES = 500
+# Размеры синтетических страниц для замера разбиения на чанки и общий объем текста на замер
+CHUNKING_PAGE_SIZES = "10000,100000,1000000"
+CHUNKING_CHARS = 5_000_000
+
+PROGRAM_NAMES = ["Искусственный интеллект", "Управление AI-продуктами"]
+WORDS = (
+    "обучение магистратура программа студент проект дисциплина экзамен стоимость бюджет место "
+    "поступление портфолио собеседование машинное глубокое нейронная сеть данные анализ продукт "
+    "менеджмент карьера выпускник инженер исследователь стажировка партнер компания семестр модуль "
+    "практика python математика статистика алгоритм модель качество метрика эксперимент команда "
+    "разработка внедрение бизнес стратегия рынок пользователь интерфейс сервис платформа облако "
+    "оптимизация вычисление лекция семинар преподаватель научный руководитель диплом защита"
+).split()
+QUESTION_TEMPLATES = [
+    "Сколько стоит {} на программе?",
+    "Какие {} нужно сдавать при поступлении?",
+    "Есть ли {} и {} в учебном плане?",
+    "Кем работают выпускники, если интересует {}?",
+    "Расскажи про {} и {}.",
+]
+
+
+def fake_vector(text: str, dimension: int = EMBEDDING_DIM) -> np.ndarray:
+    """Детерминированный нормализованный вектор текста (не зависит от запуска и процесса)."""
+    seed = int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype('float32')
+    return vector / np.linalg.norm(vector)
+
+
+def current_rss_mb() -> float:
+    """Текущий объем резидентной памяти процесса, МБ."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # Не Linux: берем пиковое значение
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def latency_stats(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+    return {"count": len(samples), "mean": float(np.mean(samples)),
+            "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+# ---- ПОДДЕЛЬНЫЙ OLLAMA ----
+
+class FakeOllama:
+    """
+    HTTP-сервер с API Ollama (/api/embeddings, /api/embed, /api/generate,
+    /api/chat) для замеров без модели: векторы детерминированы, ответы
+    генерируются с заданными задержками и поддерживают потоковую выдачу.
+    """
+
+    def __init__(self, dimension: int = EMBEDDING_DIM, embed_latency: float = EMBED_LATENCY,
+                 prefill_latency: float = PREFILL_LATENCY, token_latency: float = TOKEN_LATENCY,
+                 answer_tokens: int = ANSWER_TOKENS):
+        self.dimension = dimension
+        self.embed_latency = embed_latency
+        self.prefill_latency = prefill_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.requests = {"embed": 0, "generate": 0}
+        self._runner: web.AppRunner | None = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/api/embeddings", self.handle_embeddings)
+        self.app.router.add_post("/api/embed", self.handle_embed)
+        self.app.router.add_post("/api/generate", self.handle_generate)
+        self.app.router.add_post("/api/chat", self.handle_generate)
+
+    async def start(self, host: str = FAKE_OLLAMA_HOST, port: int = FAKE_OLLAMA_PORT) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}/api/"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle_embeddings(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.requests["embed"] += 1
+        await asyncio.sleep(self.embed_latency)
+        return web.json_response({"embedding": fake_vector(payload["prompt"], self.dimension).tolist()})
+
+    async def handle_embed(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        texts = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        self.requests["embed"] += 1
+        await asyncio.sleep(self.embed_latency)
+        return web.json_response({"embeddings": [fake_vector(text, self.dimension).tolist() for text in texts]})
+
+    async def handle_generate(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests["generate"] += 1
+        prompt = payload.get("prompt") or "".join(m["content"] for m in payload.get("messages", []))
+        limit = payload.get("options", {}).get("num_predict", self.answer_tokens)
+        tokens = [f"{WORDS[i % len(WORDS)]} " for i in range(min(limit, self.answer_tokens))]
+        chat = request.path.endswith("chat")
+        stats = {
+            "done": True,
+            "prompt_eval_count": len(prompt) // 3,
+            "prompt_eval_duration": int(self.prefill_latency * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(self.token_latency * len(tokens) * 1e9),
+        }
+
+        def chunk(text: str) -> dict:
+            return {"message": {"role": "assistant", "content": text}} if chat else {"response": text}
+
+        await asyncio.sleep(self.prefill_latency)
+        if not payload.get("stream", True):
+            await asyncio.sleep(self.token_latency * len(tokens))
+            return web.json_response({**chunk("".join(tokens)), **stats})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(self.token_latency)
+            await response.write((json.dumps({**chunk(token), "done": False}, ensure_ascii=False) + "\n").encode('utf-8'))
+        await response.write((json.dumps({**chunk(""), **stats}) + "\n").encode('utf-8'))
+        await response.write_eof()
+        return response
+
+
+# ---- СИНТЕТИЧЕСКАЯ БАЗА ЗНАНИЙ ----
+
+def synthetic_text(rng: random.Random, min_length: int = 128, max_length: int = 512) -> str:
+    words, length = [], 0
+    target = rng.randint(min_length, max_length)
+    while length < target:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return (" ".join(words)[:max_length].rsplit(" ", 1)[0].capitalize() + ".")
+
+
+def synthetic_chunks(count: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [{
+        "source": f"https://example.org/program/{i % len(PROGRAM_NAMES)}",
+        "program_name": PROGRAM_NAMES[i % len(PROGRAM_NAMES)],
+        "text": synthetic_text(rng),
+        "chunk_id": f"synthetic:{i}",
+    } for i in range(count)]
+
+
+def build_synthetic_kb(count: int, dimension: int, index_spec: str) -> tuple[list[dict], dict]:
+    """
+    Создает в ./data синтетическую базу знаний из `count` чанков теми же
+    функциями, что и create_knowledge_base.py. Возвращает чанки и замеры сборки.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    report = {"chunks": count, "dimension": dimension, "index": index_spec}
+
+    started = time.perf_counter()
+    chunks = synthetic_chunks(count)
+    embeddings = np.empty((count, dimension), dtype='float32')
+    for i, chunk in enumerate(chunks):
+        embeddings[i] = fake_vector(chunk['text'], dimension)
+    report["generate_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ids = np.array([chunk_faiss_id(chunk['chunk_id']) for chunk in chunks], dtype='int64')
+    index, meta = build_index(embeddings, index_spec, ids=ids)
+    report["index_build_seconds"] = time.perf_counter() - started
+    del embeddings
+
+    started = time.perf_counter()
+    bm25 = BM25Index.build([chunk['text'] for chunk in chunks])
+    report["bm25_build_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bm25.save(BM25_INDEX_FILE)
+    save_index(index, meta, FAISS_INDEX_FILE, INDEX_META_FILE)
+    ChunkStore.write(chunks, CHUNK_STORE_FILE)
+    report["save_seconds"] = time.perf_counter() - started
+    report["index_bytes"] = os.path.getsize(FAISS_INDEX_FILE)
+    report["rss_mb_after_build"] = current_rss_mb()
+    return chunks, report
+
+
+def synthetic_questions(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        template = rng.choice(QUESTION_TEMPLATES)
+        questions.append(template.format(*(rng.choice(WORDS) for _ in range(template.count("{}")))))
+    return questions
+
+
+# ---- СИМУЛЯЦИЯ TELEGRAM ----
+
+class FakeChat:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def send_message(self, text: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.latency)
+        return FakeMessage(text, self)
+
+
+class FakeMessage:
+    """Сообщение Telegram с методами, которые вызывают обработчики бота."""
+
+    def __init__(self, text: str, chat: FakeChat):
+        self.text = text
+        self.chat = chat
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        return await self.chat.send_message(text)
+
+    async def reply_html(self, text: str, **kwargs) -> "FakeMessage":
+        return await self.chat.send_message(text)
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.chat.latency)
+        self.text = text
+        return self
+
+
+class FakeUser:
+    def mention_html(self) -> str:
+        return "<b>Абитуриент</b>"
+
+
+class FakeUpdate:
+    def __init__(self, text: str, latency: float):
+        self.message = FakeMessage(text, FakeChat(latency))
+        self.effective_user = FakeUser()
+
+
+# ---- ЗАМЕРЫ ----
+
+def benchmark_retrieval(bot, questions: list[str], dimension: int) -> dict:
+    """Задержка find_relevant_chunks без Ollama (эмбеддинги вопросов посчитаны заранее)."""
+    embeddings = [fake_vector(question, dimension) for question in questions]
+
+    async def run() -> list[float]:
+        samples = []
+        for question, embedding in zip(questions, embeddings):
+            started = time.perf_counter()
+            await bot.find_relevant_chunks(question, question_embedding=embedding)
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    started = time.perf_counter()
+    samples = asyncio.run(run())
+    return {"qps": len(samples) / (time.perf_counter() - started), "latency": latency_stats(samples)}
+
+
+def benchmark_chunking(page_sizes: list[int], overlap: int = 0) -> list[dict]:
+    """Скорость parser.iter_chunks на больших синтетических страницах."""
+    from parser import iter_chunks
+
+    rng = random.Random(2)
+    results = []
+    for page_size in page_sizes:
+        parts, length = [], 0
+        while length < page_size:
+            parts.append(synthetic_text(rng, 20, 300))
+            length += len(parts[-1]) + 1
+        text = " ".join(parts)
+        repeats = max(1, CHUNKING_CHARS // len(text))
+        started = time.perf_counter()
+        for _ in range(repeats):
+            chunks = sum(1 for _ in iter_chunks(text, overlap=overlap))
+        elapsed = time.perf_counter() - started
+        results.append({"page_chars": len(text), "chunks": chunks, "overlap": overlap, "repeats": repeats,
+                        "chars_per_second": len(text) * repeats / elapsed, "ms_per_page": elapsed * 1000 / repeats})
+    return results
+
+
+async def simulate_conversations(bot, fake: FakeOllama, args) -> dict:
+    """Прогоняет параллельные диалоги через обработчики бота и замеряет их задержку."""
+    url = await fake.start(port=args.port)
+    bot.ollama.base_url = url
+    questions = synthetic_questions(args.conversations * args.questions, seed=3)
+    rng = random.Random(4)
+    latencies: dict[str, list[float]] = {"process_question": [], "compare_programs_command": []}
+
+    async def conversation(user: int) -> None:
+        for turn in range(args.questions):
+            if rng.random() < args.compare_share:
+                handler, text = bot.compare_programs_command, "Сравнить программы"
+            else:
+                handler, text = bot.process_question, questions[user * args.questions + turn]
+            started = time.perf_counter()
+            await handler(FakeUpdate(text, args.telegram_latency), None)
+            latencies[handler.__name__].append(time.perf_counter() - started)
+
+    requests_before = dict(fake.requests)
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(conversation(user) for user in range(args.conversations)))
+    finally:
+        elapsed = time.perf_counter() - started
+        await bot.ollama.aclose()
+        await fake.stop()
+
+    total = sum(len(samples) for samples in latencies.values())
+    return {
+        "conversations": args.conversations,
+        "requests": total,
+        "seconds": elapsed,
+        "qps": total / elapsed,
+        "ollama_requests": {kind: fake.requests[kind] - requests_before[kind] for kind in fake.requests},
+        "handlers": {name: latency_stats(samples) for name, samples in latencies.items()},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Замеры производительности бота без Ollama и Telegram. Результат — JSON-отчет.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Размеры синтетических баз через запятую (от 1000 до 1000000 чанков).")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM,
+                        help="Размерность эмбеддингов (для баз от 10^5 чанков разумно уменьшить, например до 128).")
+    parser.add_argument("--index", default=DEFAULT_INDEX_SPEC, help="Тип индекса FAISS, как в create_knowledge_base.py.")
+    parser.add_argument("--conversations", type=int, default=CONVERSATIONS, help="Число одновременных диалогов.")
+    parser.add_argument("--questions", type=int, default=QUESTIONS_PER_CONVERSATION, help="Вопросов в каждом диалоге.")
+    parser.add_argument("--compare-share", type=float, default=COMPARE_SHARE,
+                        help="Доля нажатий 'Сравнить программы'.")
+    parser.add_argument("--search-queries", type=int, default=SEARCH_QUERIES,
+                        help="Число запросов для замера поиска по базе.")
+    parser.add_argument("--page-sizes", default=CHUNKING_PAGE_SIZES,
+                        help="Размеры страниц в символах для замера разбиения на чанки.")
+    parser.add_argument("--chunk-overlap", type=int, default=0, help="Перекрытие чанков при замере разбиения.")
+    parser.add_argument("--embed-latency", type=float, default=EMBED_LATENCY)
+    parser.add_argument("--prefill-latency", type=float, default=PREFILL_LATENCY)
+    parser.add_argument("--token-latency", type=float, default=TOKEN_LATENCY)
+    parser.add_argument("--answer-tokens", type=int, default=ANSWER_TOKENS)
+    parser.add_argument("--telegram-latency", type=float, default=TELEGRAM_LATENCY)
+    parser.add_argument("--port", type=int, default=FAKE_OLLAMA_PORT, help="Порт поддельного Ollama.")
+    parser.add_argument("--no-conversations", action="store_true", help="Не запускать симуляцию диалогов.")
+    parser.add_argument("--output", help="Файл для JSON-отчета (по умолчанию — stdout).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+              "settings": vars(args),
+              "chunking": benchmark_chunking([int(size) for size in args.page_sizes.split(",")], args.chunk_overlap), "knowledge_bases": []}
+
+    # Бот читает базу из ./data, поэтому работаем во временном каталоге.
+    # Кэш похожих ответов отключен, иначе повторяющиеся вопросы не доходят до модели.
+    output_path = os.path.abspath(args.output) if args.output else None
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp(prefix="kb-benchmark-"))
+    os.environ["SEMANTIC_CACHE_THRESHOLD"] = "2"
+    bot = None
+    for size in sizes:
+        print(f"База из {size} чанков...", file=sys.stderr)
+        chunks, kb_report = build_synthetic_kb(size, args.dim, args.index)
+        del chunks
+        if bot is None:
+            sys.path.insert(0, project_dir)
+            import bot
+            logging.getLogger().setLevel(logging.WARNING)
+        bot.set_knowledge_base(bot.load_knowledge_base())
+        if os.path.exists(os.path.join(DATA_DIR, "compare_answer.json")):
+            os.remove(os.path.join(DATA_DIR, "compare_answer.json"))
+
+        kb_report["retrieval"] = benchmark_retrieval(bot, synthetic_questions(args.search_queries), args.dim)
+        if not args.no_conversations:
+            fake = FakeOllama(args.dim, args.embed_latency, args.prefill_latency, args.token_latency, args.answer_tokens)
+            kb_report["conversations"] = asyncio.run(simulate_conversations(bot, fake, args))
+        kb_report["rss_mb"] = current_rss_mb()
+        report["knowledge_bases"].append(kb_report)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
+import time
+
+# Отсчет времени запуска бота: начинается до импорта зависимостей
+STARTED_AT = time.monotonic()
+
+import asyncio
 import logging
-import json
 import os
-import requests
+from typing import TYPE_CHECKING
+
 import numpy as np
-import faiss
 
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Update, ReplyKeyboardMarkup, Message
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -17,6 +23,31 @@ from telegram.ext import (
 
 # Импортируем наш модуль рекомендаций
 from recommender import get_recommendation
+from ollama_client import (
+    AsyncOllamaClient,
+    OllamaError,
+    OllamaUnavailableError,
+    OLLAMA_API_URL,
+    EMBEDDING_MODEL,
+    LLM_MODEL,
+    GENERATION_TIMEOUT,
+)
+from ollama_scheduler import OllamaScheduler, SchedulerBusyError
+from lexical_index import reciprocal_rank_fusion
+from context_builder import assemble_context, CONTEXT_TOKEN_BUDGET
+from prompts import RAG_PROMPT, WARMUP_QUESTION
+from metrics import metrics
+from micro_batcher import MicroBatcher, MAX_BATCH_SIZE, MAX_WAIT
+# База знаний (и FAISS) импортируется при ее загрузке в фоне, см. load_knowledge_base
+if TYPE_CHECKING:
+    from knowledge_base import KnowledgeBase
+from answer_cache import (
+    load_precomputed_answer,
+    save_precomputed_answer,
+    SemanticAnswerCache,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_PATH,
+)
 
 from dotenv import load_dotenv
 
@@ -33,15 +64,77 @@ logger = logging.getLogger(__name__)
 # Токен вашего бота
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-# Настройки для Ollama
-OLLAMA_API_URL = "http://localhost:11434/api/"
-EMBEDDING_MODEL = "nomic-embed-text"
-LLM_MODEL = "qwen3:8b"
-
-# Пути к файлам базы знаний
-DATA_DIR = "data"
-CHUNKS_FILE = os.path.join(DATA_DIR, "text_chunks.json")
-FAISS_INDEX_FILE = os.path.join(DATA_DIR, "faiss_index.bin")
+# Настройки для Ollama (адрес и модели общие для всех скриптов, см. ollama_client.py)
+# Сколько Ollama держит модели в памяти после последнего запроса ("-1" — всегда)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Прогревать ли модели при запуске бота, чтобы первый пользователь не ждал их загрузки
+OLLAMA_WARMUP = os.getenv("OLLAMA_WARMUP", "1") != "0"
+
+# Настройки потоковой выдачи ответов в Telegram
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") != "0"
+STREAM_EDIT_INTERVAL = 1.5  # Минимальный интервал между правками одного сообщения, с
+STREAM_MIN_NEW_CHARS = 40  # Минимальный прирост текста для очередной правки
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Ответы, которые не являются результатом успешной генерации
+LLM_ERROR_ANSWER = "Извините, произошла ошибка при обращении к языковой модели. Попробуйте позже."
+LLM_EMPTY_ANSWER = "Модель не дала ответа."
+LLM_INTERRUPTED_NOTE = "(Ответ прерван из-за ошибки языковой модели.)"
+LLM_BUSY_ANSWER = "Сейчас слишком много запросов к языковой модели. Пожалуйста, попробуйте через пару минут."
+LLM_UNAVAILABLE_ANSWER = "Языковая модель сейчас недоступна. Пожалуйста, попробуйте позже."
+
+# Ограничения одновременных запросов к Ollama и длина очереди ожидания
+OLLAMA_EMBED_CONCURRENCY = int(os.getenv("OLLAMA_EMBED_CONCURRENCY", "2"))
+OLLAMA_GENERATE_CONCURRENCY = int(os.getenv("OLLAMA_GENERATE_CONCURRENCY", "1"))
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "20"))
+# Каталог файлов блокировки, через которые ограничения выше действуют сразу для
+# всех процессов бота (пусто — только для этого процесса); в режиме webhook задается автоматически
+OLLAMA_SLOTS_DIR = os.getenv("OLLAMA_SLOTS_DIR", "")
+
+# Фиксированный вопрос для кнопки "Сравнить программы": ответ на него
+# зависит только от базы знаний, поэтому генерируется один раз на ее версию
+COMPARE_QUESTION = "Сравни магистерские программы 'Искусственный интеллект' и 'Управление AI-продуктами'. Опиши их ключевые цели, для кого они подходят, и кем становятся выпускники. Представь ответ в виде сравнения по пунктам."
+
+# Порог сходства вопросов для повторного использования готового ответа
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", SEMANTIC_CACHE_THRESHOLD))
+# Файлы кэша ответов (без расширения); у каждого процесса бота должен быть свой
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", SEMANTIC_CACHE_PATH)
+# Готовить ли заранее ответ для кнопки "Сравнить программы" (в режиме webhook — только в одном процессе)
+PRECOMPUTE_ANSWERS = os.getenv("PRECOMPUTE_ANSWERS", "1") != "0"
+
+# Параметры поиска для приближенных индексов (0 — взять из метаданных индекса)
+FAISS_SEARCH_PARAMS = {
+    "efSearch": int(os.getenv("FAISS_EF_SEARCH", "0")),
+    "nprobe": int(os.getenv("FAISS_NPROBE", "0")),
+}
+# Отображать индекс FAISS в память только для чтения (mmap) вместо загрузки копии:
+# процессы бота в режиме webhook разделяют одни и те же страницы файла
+FAISS_MMAP = os.getenv("FAISS_MMAP", "0") != "0"
+
+# Гибридный поиск: сколько кандидатов на каждый итоговый чанк берется из FAISS и BM25
+HYBRID_CANDIDATES_FACTOR = 3
+# Сколько кандидатов на каждый чанк контекста отбирается для MMR
+CONTEXT_CANDIDATES_FACTOR = 2
+# Жесткий бюджет контекста в промпте, токенов (для сравнения программ — отдельный, побольше)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", CONTEXT_TOKEN_BUDGET))
+COMPARE_CONTEXT_TOKEN_BUDGET = int(os.getenv("COMPARE_CONTEXT_TOKEN_BUDGET", "2500"))
+# Если эмбеддинг вопроса не получен за это время, поиск идет только по BM25
+QUERY_EMBEDDING_TIMEOUT = float(os.getenv("QUERY_EMBEDDING_TIMEOUT", "10"))
+# Пакетная обработка запросов разных пользователей: одиночный запрос выполняется
+# сразу, а запросы, пришедшие во время уже идущего обращения, собираются в пакет
+# и отправляются одним обращением после него, но не позже QUERY_BATCH_MAX_WAIT_MS
+# миллисекунд (не больше QUERY_BATCH_MAX_SIZE запросов; 1 — без пакетов)
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", MAX_BATCH_SIZE))
+QUERY_BATCH_MAX_WAIT = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", MAX_WAIT * 1000)) / 1000
+
+# Как часто бот проверяет, не пересобрана ли база знаний, с
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "5"))
+
+# Экспорт замеров задержки: порт HTTP-эндпоинта Prometheus (0 — не запускать)
+# и интервал вывода перцентилей в лог, с (0 — не выводить)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
 
 # Состояния для диалогов
 STATE_ASK_BACKGROUND = 1
@@ -49,85 +142,441 @@ STATE_ASK_QUESTION = 2
 
 # ---- 2. ЗАГРУЗКА БАЗЫ ЗНАНИЙ ----
 
-try:
-    faiss_index = faiss.read_index(FAISS_INDEX_FILE)
-    with open(CHUNKS_FILE, 'r', encoding='utf-8') as f:
-        text_chunks = json.load(f)
-    logger.info(f"База знаний успешно загружена: {faiss_index.ntotal} векторов.")
-except Exception as e:
-    logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить базу знаний: {e}")
-    logger.error("Убедитесь, что вы запустили parser.py, а затем create_knowledge_base.py перед стартом бота.")
-    faiss_index = None
-    text_chunks = None
+def load_knowledge_base() -> "KnowledgeBase | None":
+    """Загружает базу знаний (блокирующий вызов; бот выполняет его в отдельном потоке)."""
+    from knowledge_base import KnowledgeBase
+    try:
+        loaded = KnowledgeBase.load(FAISS_SEARCH_PARAMS, FAISS_MMAP)
+    except Exception as e:
+        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить базу знаний: {e}")
+        logger.error("Убедитесь, что вы запустили parser.py, а затем create_knowledge_base.py перед стартом бота.")
+        return None
+    logger.info(f"База знаний успешно загружена: {loaded.index.ntotal} векторов, "
+                f"индекс '{loaded.meta['type']}' (версия {loaded.version}).")
+    return loaded
+
+# Текущая база знаний. Загружается в фоне после запуска бота, чтобы /start и
+# рекомендации работали сразу; обработчики, которым нужна база, ждут kb_loaded.
+# При обновлении файлов ссылка подменяется целиком, поэтому обработчик, взявший
+# ее в начале запроса, работает с согласованной версией
+kb: "KnowledgeBase | None" = None
+# Устанавливается, когда первая загрузка базы знаний завершилась (успешно или нет)
+kb_loaded = asyncio.Event()
+
+# Кэш ответов на похожие вопросы; создается вместе с базой знаний и сбрасывается при смене ее версии
+semantic_cache: SemanticAnswerCache | None = None
+
+def set_knowledge_base(new_kb: "KnowledgeBase") -> None:
+    """Делает `new_kb` текущей базой знаний и сбрасывает кэш ответов, привязанный к прежней."""
+    global kb, semantic_cache
+    if semantic_cache is None:
+        semantic_cache = SemanticAnswerCache(SEMANTIC_CACHE_PATH, kb_version=new_kb.version,
+                                             threshold=SEMANTIC_CACHE_THRESHOLD)
+    else:
+        semantic_cache.invalidate(new_kb.version)
+    kb = new_kb
+    kb_loaded.set()
+
+async def wait_for_knowledge_base() -> "KnowledgeBase | None":
+    """Дожидается первой загрузки базы знаний и возвращает текущую (None, если ее нет)."""
+    await kb_loaded.wait()
+    return kb
+
+async def load_knowledge_base_in_background() -> None:
+    """Первая загрузка базы знаний после запуска бота, в отдельном потоке."""
+    started = time.monotonic()
+    try:
+        loaded = await asyncio.to_thread(load_knowledge_base)
+        if loaded is not None:
+            set_knowledge_base(loaded)
+    finally:
+        kb_loaded.set()
+    metrics.observe("kb_load", time.monotonic() - started, handler="startup")
+    if loaded is not None:
+        logger.info(f"База знаний загружена в фоне за {time.monotonic() - started:.2f} с "
+                    f"({time.monotonic() - STARTED_AT:.2f} с от запуска бота).")
+
+async def watch_knowledge_base() -> None:
+    """
+    Следит за файлами базы знаний и подменяет ее без перезапуска бота.
+    Новая версия загружается в отдельном потоке, не блокируя обработку запросов.
+    """
+    await kb_loaded.wait()
+    from knowledge_base import KnowledgeBase, get_kb_version
+    while True:
+        await asyncio.sleep(KB_WATCH_INTERVAL)
+        version = get_kb_version()
+        if version is None or (kb is not None and version == kb.version):
+            continue
+        try:
+            new_kb = await asyncio.to_thread(KnowledgeBase.load, FAISS_SEARCH_PARAMS, FAISS_MMAP)
+        except Exception as e:
+            # Скорее всего, пересборка еще идет — попробуем на следующей проверке
+            logger.info(f"Новая версия базы знаний пока не загружена: {e}")
+            continue
+        set_knowledge_base(new_kb)
+        logger.info(f"База знаний обновлена без перезапуска: {new_kb.index.ntotal} векторов (версия {new_kb.version}).")
+        restart_compare_precompute()
 
 # ---- 3. ФУНКЦИИ ДЛЯ РАБОТЫ С OLLAMA И RAG ----
 
-def get_embedding(text: str) -> np.ndarray | None:
-    """Получает эмбеддинг для текста через API Ollama."""
+# Общий асинхронный клиент: запросы разных пользователей выполняются параллельно
+ollama = AsyncOllamaClient(OLLAMA_API_URL, response_hook=metrics.record_ollama_response)
+# Все обращения к Ollama идут через планировщик: он ограничивает нагрузку,
+# пропускает эмбеддинги вперед генераций и объединяет одинаковые запросы
+scheduler = OllamaScheduler(
+    ollama,
+    embed_concurrency=OLLAMA_EMBED_CONCURRENCY,
+    generate_concurrency=OLLAMA_GENERATE_CONCURRENCY,
+    max_concurrency=OLLAMA_MAX_CONCURRENCY,
+    max_queue=OLLAMA_MAX_QUEUE,
+    shared_dir=OLLAMA_SLOTS_DIR or None,
+)
+
+async def embed_queries(texts: list[str]) -> list[np.ndarray]:
+    """Эмбеддинги пакета запросов одним обращением к Ollama (одинаковые тексты считаются один раз)."""
+    unique = list(dict.fromkeys(texts))
+    vectors = await scheduler.embed_batch(unique, EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE)
+    by_text = dict(zip(unique, vectors))
+    return [by_text[text] for text in texts]
+
+async def search_vectors(queries: list[tuple["KnowledgeBase", np.ndarray, int]]) -> list[list[int]]:
+    """
+    Векторный поиск для пакета запросов (база знаний, эмбеддинг, top_k):
+    один вызов FAISS на каждую версию базы знаний с наибольшим из top_k.
+    """
+    results: list[list[int]] = [[] for _ in queries]
+    groups: dict[int, list[int]] = {}
+    for i, (current_kb, _, _) in enumerate(queries):
+        groups.setdefault(id(current_kb), []).append(i)
+    for positions in groups.values():
+        current_kb = queries[positions[0]][0]
+        top_k = max(queries[i][2] for i in positions)
+        found = current_kb.search_vectors_batch(np.stack([queries[i][1] for i in positions]), top_k)
+        for i, ids in zip(positions, found):
+            results[i] = ids[:queries[i][2]]
+    return results
+
+embedding_batcher = MicroBatcher(embed_queries, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT, name="embeddings")
+search_batcher = MicroBatcher(search_vectors, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT, name="faiss")
+
+async def get_embedding(text: str, timeout: float = 30) -> np.ndarray | None:
+    """
+    Получает эмбеддинг для текста через API Ollama (`timeout` включает ожидание
+    в очереди). Запросы, пришедшие почти одновременно, отправляются одним пакетом.
+    """
     try:
-        response = requests.post(
-            f"{OLLAMA_API_URL}embeddings",
-            json={"model": EMBEDDING_MODEL, "prompt": text},
-            timeout=30
-        )
-        response.raise_for_status()
-        return np.array(response.json().get("embedding"), dtype='float32')
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при получении эмбеддинга от Ollama: {e}")
+        with metrics.span("embedding"):
+            return await asyncio.wait_for(embedding_batcher.submit(text), timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Эмбеддинг от Ollama не получен за {timeout} с.")
         return None
-    except (KeyError, TypeError):
-        logger.error("Не удалось извлечь эмбеддинг из ответа Ollama.")
+    except OllamaError as e:
+        logger.error(f"Ошибка при получении эмбеддинга от Ollama: {e}")
         return None
 
-def find_relevant_chunks(question: str, top_k: int = 5) -> str:
-    """Находит релевантные чанки в базе знаний и возвращает их как единый контекст."""
-    if not faiss_index or not text_chunks:
+async def search_chunks(current_kb: "KnowledgeBase", question: str, question_embedding: np.ndarray | None,
+                        top_k: int) -> list[int]:
+    """
+    Гибридный поиск: объединяет выдачу FAISS и BM25 через reciprocal rank fusion.
+    Без эмбеддинга вопроса используется только лексический поиск.
+    """
+    candidates = top_k * HYBRID_CANDIDATES_FACTOR
+    rankings = []
+    if question_embedding is not None:
+        with metrics.span("faiss_search"):
+            rankings.append(await search_batcher.submit((current_kb, question_embedding, candidates)))
+    if current_kb.bm25 is not None:
+        with metrics.span("bm25_search"):
+            rankings.append([doc_id for doc_id, score in current_kb.bm25.search(question, candidates)])
+    return reciprocal_rank_fusion(rankings)[:top_k]
+
+async def find_relevant_chunks(question: str, top_k: int = 5,
+                               question_embedding: np.ndarray | None = None,
+                               lexical_only: bool = False,
+                               token_budget: int = CONTEXT_TOKEN_BUDGET,
+                               balance_programs: bool = False) -> str:
+    """
+    Находит релевантные чанки в базе знаний и возвращает их как единый контекст
+    не длиннее `token_budget` токенов (см. context_builder.assemble_context).
+    Если эмбеддинг вопроса уже получен, его можно передать в `question_embedding`;
+    `lexical_only=True` — искать только по BM25, не обращаясь к Ollama.
+    Если база знаний еще загружается, ждет окончания загрузки.
+    """
+    current_kb = await wait_for_knowledge_base()
+    if not current_kb or not current_kb.chunks:
         return "База знаний недоступна."
 
-    question_embedding = get_embedding(question)
+    if question_embedding is None and not lexical_only:
+        question_embedding = await get_embedding(question, timeout=QUERY_EMBEDDING_TIMEOUT)
     if question_embedding is None:
-        return "Не удалось обработать ваш вопрос для поиска по базе знаний."
-
-    # FAISS требует 2D-массив для поиска
-    question_embedding_np = np.array([question_embedding])
-    
-    distances, indices = faiss_index.search(question_embedding_np, top_k)
-    
-    context = ""
-    for i in indices[0]:
-        if i != -1:
-            chunk = text_chunks[i]
-            context += f"Фрагмент из описания программы '{chunk['program_name']}':\n---\n{chunk['text']}\n---\n\n"
-    
-    return context.strip() if context else "В базе знаний не найдено релевантной информации."
-
-def get_llm_response(question: str, context: str) -> str:
-    """Отправляет запрос к языковой модели с вопросом и контекстом."""
-    prompt = f"""
-Ты — дружелюбный и экспертный ИИ-ассистент для абитуриентов ИТМО.
-Твоя задача — максимально точно и полно ответить на вопрос пользователя, используя ТОЛЬКО предоставленный ниже контекст.
-Не придумывай информацию. Если в контексте нет прямого ответа, скажи, что не можешь найти точную информацию по этому вопросу в доступных материалах.
-Отвечай структурированно и по делу.
-
-КОНТЕКСТ:
-{context}
+        if current_kb.bm25 is None:
+            return "Не удалось обработать ваш вопрос для поиска по базе знаний."
+        logger.warning("Эмбеддинг вопроса недоступен, поиск выполняется только по BM25.")
+
+    candidates = [current_kb.chunks[i] for i in
+                  await search_chunks(current_kb, question, question_embedding, top_k * CONTEXT_CANDIDATES_FACTOR)]
+    with metrics.span("context"):
+        context = assemble_context(candidates, top_k, token_budget=token_budget, balance_programs=balance_programs)
+    logger.info(f"Контекст: {len(context.chunks)} чанков, ~{context.tokens} токенов, "
+                f"сэкономлено ~{context.saved_tokens} токенов (дубликатов отброшено: {context.duplicates}).")
+
+    return context.text or "В базе знаний не найдено релевантной информации."
+
+def build_messages(question: str, context: str) -> list[dict]:
+    """Собирает сообщения для чат-модели: постоянная системная часть, затем контекст и вопрос."""
+    return RAG_PROMPT.messages(context=context, question=question)
+
+def queue_notifier(message: Message | None):
+    """Возвращает функцию, сообщающую пользователю его позицию в очереди к модели."""
+    if message is None:
+        return None
 
-ВОПРОС:
-{question}
+    async def notify(position: int) -> None:
+        await message.edit_text(f"Запрос в очереди к языковой модели, перед вами: {position - 1}. "
+                                "Ответ начнет появляться, как только подойдет ваша очередь.")
+    return notify
 
-ТВОЙ ОТВЕТ:
-"""
+async def get_llm_response(question: str, context: str, status_message: Message | None = None) -> str:
+    """Отправляет запрос к языковой модели с вопросом и контекстом."""
+    messages = build_messages(question, context)
     try:
-        response = requests.post(
-            f"{OLLAMA_API_URL}generate",
-            json={"model": LLM_MODEL, "prompt": prompt, "stream": False, "think": False},
-            timeout=120  # Увеличим таймаут для генерации
-        )
-        response.raise_for_status()
-        return response.json().get('response', "Модель не дала ответа.").strip()
-    except requests.exceptions.RequestException as e:
+        with metrics.span("llm"):
+            answer = await scheduler.chat(messages, LLM_MODEL, timeout=GENERATION_TIMEOUT,
+                                          on_queued=queue_notifier(status_message),
+                                          think=False, keep_alive=OLLAMA_KEEP_ALIVE)
+        if not answer.strip():
+            metrics.count("llm_error_replies_total", reason="empty")
+            return LLM_EMPTY_ANSWER
+        return answer.strip()
+    except SchedulerBusyError as e:
+        logger.warning(f"Запрос к LLM отклонен: {e}")
+        metrics.count("llm_error_replies_total", reason="busy")
+        return LLM_BUSY_ANSWER
+    except OllamaUnavailableError as e:
+        logger.warning(f"Запрос к LLM не отправлен: {e}")
+        metrics.count("llm_error_replies_total", reason="unavailable")
+        return LLM_UNAVAILABLE_ANSWER
+    except OllamaError as e:
         logger.error(f"Ошибка при запросе к LLM Ollama: {e}")
-        return "Извините, произошла ошибка при обращении к языковой модели. Попробуйте позже."
+        metrics.count("llm_error_replies_total", reason="error")
+        return LLM_ERROR_ANSWER
+
+class StreamingReply:
+    """
+    Сообщение Telegram, которое постепенно дополняется текстом ответа.
+
+    Правки объединяются и выполняются не чаще STREAM_EDIT_INTERVAL, чтобы
+    не упираться в лимиты Telegram на редактирование. Если текст не
+    помещается в одно сообщение, продолжение отправляется новым сообщением.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.offset = 0  # Позиция начала текущего сообщения в полном тексте
+        self.shown = ""
+        self.next_edit_at = 0.0
+        self.first_visible_at: float | None = None
+
+    async def update(self, text: str, final: bool = False) -> None:
+        if not final and (time.monotonic() < self.next_edit_at
+                          or len(text) - self.offset - len(self.shown) < STREAM_MIN_NEW_CHARS):
+            return
+
+        visible = text[self.offset:]
+        while len(visible) > TELEGRAM_MESSAGE_LIMIT:
+            cut = visible.rfind("\n", 0, TELEGRAM_MESSAGE_LIMIT)
+            if cut <= 0:
+                cut = TELEGRAM_MESSAGE_LIMIT
+            await self._edit(visible[:cut], force=True)
+            self.offset += cut
+            visible = text[self.offset:]
+            self.shown = visible[:TELEGRAM_MESSAGE_LIMIT]
+            self.message = await self.message.chat.send_message(self.shown.strip() or "...")
+
+        await self._edit(visible, force=final)
+
+    async def _edit(self, text: str, force: bool) -> None:
+        if not text.strip() or text == self.shown:
+            return
+        try:
+            with metrics.span("reply"):
+                await self.message.edit_text(text.strip())
+        except RetryAfter as e:
+            self.next_edit_at = time.monotonic() + float(e.retry_after)
+            if not force:
+                return
+            await asyncio.sleep(float(e.retry_after))
+            await self.message.edit_text(text.strip())
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Не удалось обновить сообщение с ответом: {e}")
+            return
+        self.shown = text
+        self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        if self.first_visible_at is None:
+            self.first_visible_at = time.monotonic()
+
+async def stream_llm_response(message: Message, question: str, context: str) -> str:
+    """
+    Генерирует ответ потоком и показывает его в сообщении `message`,
+    редактируя его по мере поступления токенов. Возвращает полный ответ.
+    """
+    messages = build_messages(question, context)
+    reply = StreamingReply(message)
+    started = time.monotonic()
+    first_token_at = None
+    answer = ""
+    try:
+        async for token in scheduler.chat_stream(messages, LLM_MODEL, timeout=GENERATION_TIMEOUT,
+                                                 on_queued=queue_notifier(message),
+                                                 think=False, keep_alive=OLLAMA_KEEP_ALIVE):
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+                metrics.observe("llm_first_token", first_token_at - started)
+            answer += token
+            await reply.update(answer)
+    except SchedulerBusyError as e:
+        logger.warning(f"Потоковый запрос к LLM отклонен: {e}")
+        metrics.count("llm_error_replies_total", reason="busy")
+        answer = LLM_BUSY_ANSWER
+    except OllamaUnavailableError as e:
+        logger.warning(f"Потоковый запрос к LLM не отправлен: {e}")
+        metrics.count("llm_error_replies_total", reason="unavailable")
+        answer = LLM_UNAVAILABLE_ANSWER
+    except OllamaError as e:
+        logger.error(f"Ошибка при потоковом запросе к LLM Ollama: {e}")
+        if not answer.strip():
+            metrics.count("llm_error_replies_total", reason="error")
+            answer = LLM_ERROR_ANSWER
+        else:
+            metrics.count("llm_error_replies_total", reason="interrupted")
+            answer += f"\n\n{LLM_INTERRUPTED_NOTE}"
+
+    metrics.observe("llm", time.monotonic() - started)
+
+    # Текст модели показан, только если пришел хотя бы один непустой токен
+    model_text_shown = first_token_at is not None and bool(answer.strip())
+    if not answer.strip():
+        metrics.count("llm_error_replies_total", reason="empty")
+        answer = LLM_EMPTY_ANSWER
+    await reply.update(answer, final=True)
+
+    # Основная метрика задержки — время до первого видимого пользователю текста ответа;
+    # сообщения об ошибках в нее не попадают, чтобы не выглядеть быстрыми ответами
+    ttft = (reply.first_visible_at or time.monotonic()) - started
+    if model_text_shown:
+        metrics.observe("first_visible", ttft)
+        logger.info(f"Ответ показан: первый текст через {ttft:.2f} с, полностью за {time.monotonic() - started:.2f} с.")
+    else:
+        logger.info(f"Вместо ответа показано сообщение об ошибке через {ttft:.2f} с.")
+    return answer.strip()
+
+def is_complete_answer(answer: str) -> bool:
+    """Проверяет, что ответ получен от модели полностью, а не является сообщением об ошибке."""
+    return answer not in (LLM_ERROR_ANSWER, LLM_EMPTY_ANSWER, LLM_BUSY_ANSWER, LLM_UNAVAILABLE_ANSWER) and not answer.endswith(LLM_INTERRUPTED_NOTE)
+
+def split_message(text: str) -> list[str]:
+    """Делит длинный текст на части, укладывающиеся в лимит сообщения Telegram."""
+    parts = []
+    while len(text) > TELEGRAM_MESSAGE_LIMIT:
+        cut = text.rfind("\n", 0, TELEGRAM_MESSAGE_LIMIT)
+        if cut <= 0:
+            cut = TELEGRAM_MESSAGE_LIMIT
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+async def precompute_compare_answer(application: Application | None = None) -> None:
+    """Заранее генерирует ответ для кнопки "Сравнить программы", если для текущей базы его еще нет."""
+    if not kb or not PRECOMPUTE_ANSWERS:
+        return
+    kb_version = kb.version
+    if load_precomputed_answer(kb_version, COMPARE_QUESTION):
+        return
+    relevant_context = await find_relevant_chunks(COMPARE_QUESTION, top_k=10, token_budget=COMPARE_CONTEXT_TOKEN_BUDGET,
+                                                  balance_programs=True)
+    if "База знаний недоступна" in relevant_context or "Не удалось обработать" in relevant_context:
+        return
+    answer = await get_llm_response(COMPARE_QUESTION, relevant_context)
+    if is_complete_answer(answer):
+        save_precomputed_answer(kb_version, COMPARE_QUESTION, answer)
+        logger.info("Ответ для кнопки 'Сравнить программы' подготовлен заранее.")
+
+async def warm_up_models() -> None:
+    """
+    Загружает модели в память Ollama до первых вопросов пользователей.
+    Языковая модель заодно обрабатывает системную часть промпта, и этот
+    префикс остается в ее KV-кэше для последующих запросов.
+    """
+    started = time.monotonic()
+    if await get_embedding(WARMUP_QUESTION, timeout=120) is None:
+        logger.warning("Не удалось прогреть модель эмбеддингов.")
+    try:
+        await scheduler.chat(RAG_PROMPT.messages(context="", question=WARMUP_QUESTION), LLM_MODEL, timeout=300,
+                             think=False, keep_alive=OLLAMA_KEEP_ALIVE, options={"num_predict": 1})
+    except OllamaError as e:
+        logger.warning(f"Не удалось прогреть языковую модель: {e}")
+        return
+    logger.info(f"Модели прогреты за {time.monotonic() - started:.1f} с.")
+
+async def prepare_models_and_answers() -> None:
+    if OLLAMA_WARMUP:
+        await warm_up_models()
+    await kb_loaded.wait()
+    restart_compare_precompute()
+
+# Генерация заранее готового ответа для текущей версии базы знаний. Идет отдельной
+# задачей, чтобы не останавливать проверку обновлений базы на время ответа модели
+compare_precompute_task: asyncio.Task | None = None
+
+def restart_compare_precompute() -> None:
+    """Запускает подготовку ответа для кнопки "Сравнить программы", отменяя подготовку для прежней версии базы."""
+    global compare_precompute_task
+    if compare_precompute_task is not None:
+        compare_precompute_task.cancel()
+    compare_precompute_task = run_in_background(precompute_compare_answer())
+
+# Фоновые задачи бота. post_init вызывается до application.start(), поэтому они
+# запускаются через asyncio.create_task, а не application.create_task, и
+# отменяются вручную в shutdown
+background_tasks: set[asyncio.Task] = set()
+
+def run_in_background(coroutine) -> asyncio.Task:
+    """Запускает фоновую задачу бота; ее ошибка попадает в лог, а не теряется до остановки бота."""
+    task = asyncio.create_task(coroutine, name=coroutine.__qualname__)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Фоновая задача {task.get_name()} завершилась с ошибкой", exc_info=task.exception())
+
+async def start_background_tasks(application: Application) -> None:
+    """Запускает фоновые задачи после инициализации бота."""
+    startup = time.monotonic() - STARTED_AT
+    metrics.observe("ready", startup, handler="startup")
+    logger.info(f"Бот готов принимать сообщения через {startup:.2f} с после запуска; база знаний загружается в фоне.")
+    run_in_background(load_knowledge_base_in_background())
+    run_in_background(prepare_models_and_answers())
+    run_in_background(watch_knowledge_base())
+    if METRICS_PORT:
+        run_in_background(metrics.serve(METRICS_PORT))
+    if METRICS_LOG_INTERVAL:
+        run_in_background(metrics.log_periodically(METRICS_LOG_INTERVAL))
+
+async def shutdown(application: Application) -> None:
+    """Останавливает фоновые задачи, сохраняет кэш ответов и закрывает пул соединений с Ollama."""
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if semantic_cache is not None:
+        semantic_cache.flush()
+    await ollama.aclose()
 
 
 # ---- 4. ОБРАБОТЧИКИ КОМАНД И ДИАЛОГОВ ----
@@ -149,17 +598,37 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup=get_main_menu_keyboard(),
     )
 
+@metrics.instrument
 async def compare_programs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    question = "Сравни магистерские программы 'Искусственный интеллект' и 'Управление AI-продуктами'. Опиши их ключевые цели, для кого они подходят, и кем становятся выпускники. Представь ответ в виде сравнения по пунктам."
-    await update.message.reply_text("Готовлю сравнение программ на основе данных с сайтов... Это может занять минуту.")
-    
-    relevant_context = find_relevant_chunks(question, top_k=10) # Берем больше чанков для полноты
+    current_kb = await wait_for_knowledge_base()
+    kb_version = current_kb.version if current_kb else None
+    cached_answer = load_precomputed_answer(kb_version, COMPARE_QUESTION)
+    if cached_answer:
+        for part in split_message(cached_answer):
+            with metrics.span("reply"):
+                await update.message.reply_text(part)
+        return
+
+    with metrics.span("status"):
+        status_message = await update.message.reply_text("Готовлю сравнение программ на основе данных с сайтов... Это может занять минуту.")
+
+    # Одновременные нажатия (и фоновая подготовка ответа) дают одинаковый промпт,
+    # поэтому планировщик выполнит одну генерацию и раздаст ее всем
+    relevant_context = await find_relevant_chunks(COMPARE_QUESTION, top_k=10, token_budget=COMPARE_CONTEXT_TOKEN_BUDGET,
+                                                  balance_programs=True) # Берем больше чанков для полноты
     if "База знаний недоступна" in relevant_context or "Не удалось обработать" in relevant_context:
         await update.message.reply_text(relevant_context)
         return
-        
-    answer = get_llm_response(question, relevant_context)
-    await update.message.reply_text(answer)
+
+    if STREAM_ANSWERS:
+        answer = await stream_llm_response(status_message, COMPARE_QUESTION, relevant_context)
+    else:
+        answer = await get_llm_response(COMPARE_QUESTION, relevant_context, status_message)
+        with metrics.span("reply"):
+            await update.message.reply_text(answer)
+
+    if is_complete_answer(answer):
+        save_precomputed_answer(kb_version, COMPARE_QUESTION, answer)
 
 # --- Блок рекомендаций ---
 async def recommendation_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -169,8 +638,15 @@ async def recommendation_start(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     return STATE_ASK_BACKGROUND
 
+@metrics.instrument
 async def process_background(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    recommendation = get_recommendation(update.message.text)
+    background = update.message.text
+    # Профили программ берутся из текущего снимка базы знаний; пока база не
+    # загружена (или без эмбеддинга) рекомендация строится по ключевым словам
+    current_kb = kb
+    profiles = current_kb.profiles if current_kb else None
+    embedding = await get_embedding(background, timeout=QUERY_EMBEDDING_TIMEOUT) if profiles else None
+    recommendation = get_recommendation(background, embedding, profiles)
     await update.message.reply_text(recommendation, parse_mode='Markdown', reply_markup=get_main_menu_keyboard())
     return ConversationHandler.END
 
@@ -181,17 +657,42 @@ async def question_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return STATE_ASK_QUESTION
 
+@metrics.instrument
 async def process_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     question = update.message.text
-    await update.message.reply_text("Ищу информацию и генерирую ответ... Пожалуйста, подождите.")
-    
-    relevant_context = find_relevant_chunks(question)
+    with metrics.span("status"):
+        status_message = await update.message.reply_text("Ищу информацию и генерирую ответ... Пожалуйста, подождите.")
+
+    # Эмбеддинг вопроса нужен и для кэша ответов, и для поиска по базе знаний
+    current_kb = await wait_for_knowledge_base()
+    question_embedding = await get_embedding(question, timeout=QUERY_EMBEDDING_TIMEOUT) if current_kb else None
+    if question_embedding is not None:
+        cached_answer = semantic_cache.lookup(question_embedding)
+        metrics.count("semantic_cache_lookups_total", result="hit" if cached_answer else "miss")
+        logger.info(f"Кэш ответов: {'попадание' if cached_answer else 'промах'}, "
+                    f"доля попаданий {semantic_cache.hit_rate:.0%} ({semantic_cache.hits}/{semantic_cache.hits + semantic_cache.misses}).")
+        if cached_answer:
+            for part in split_message(cached_answer):
+                with metrics.span("reply"):
+                    await update.message.reply_text(part, reply_markup=get_main_menu_keyboard())
+            return ConversationHandler.END
+
+    # Без эмбеддинга не ждем Ollama повторно, а сразу ищем по BM25
+    relevant_context = await find_relevant_chunks(question, question_embedding=question_embedding,
+                                                  lexical_only=question_embedding is None)
     if "База знаний недоступна" in relevant_context or "Не удалось обработать" in relevant_context:
         await update.message.reply_text(relevant_context, reply_markup=get_main_menu_keyboard())
         return ConversationHandler.END
 
-    answer = get_llm_response(question, relevant_context)
-    await update.message.reply_text(answer, reply_markup=get_main_menu_keyboard())
+    if STREAM_ANSWERS:
+        answer = await stream_llm_response(status_message, question, relevant_context)
+    else:
+        answer = await get_llm_response(question, relevant_context, status_message)
+        with metrics.span("reply"):
+            await update.message.reply_text(answer, reply_markup=get_main_menu_keyboard())
+
+    if question_embedding is not None and is_complete_answer(answer):
+        semantic_cache.put(question, question_embedding, answer)
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -201,23 +702,43 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # ---- 5. ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА БОТА ----
 
-def main() -> None:
-    """Запуск бота."""
-    if not faiss_index:
-        logger.critical("Бот не может быть запущен без базы знаний. Завершение работы.")
-        return
-        
+def check_settings() -> bool:
+    """
+    Проверяет, что задан токен. База знаний загружается уже после запуска:
+    если ее нет, бот работает без ответов на вопросы и подхватит ее, когда
+    она появится (см. watch_knowledge_base).
+    """
     if TELEGRAM_BOT_TOKEN == "ВАШ_ТЕЛЕГРАМ_ТОКЕН_ЗДЕСЬ":
         logger.critical("Необходимо указать токен Telegram-бота в переменной TELEGRAM_BOT_TOKEN.")
-        return
+        return False
+    return True
+
+def build_application(polling: bool = True) -> Application:
+    """
+    Создает приложение бота со всеми обработчиками. С `polling=False`
+    приложение не получает обновления само: их передает процесс-маршрутизатор
+    режима webhook (см. webhook.py).
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(start_background_tasks)
+        .post_shutdown(shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Обновления разбираются по очереди (ConversationHandler несовместим с
+    # concurrent_updates), а долгие обработчики с обращениями к Ollama
+    # неблокирующие (block=False): они выполняются отдельными задачами, и
+    # сообщения других пользователей не ждут их завершения
 
     # --- Диалог для рекомендаций ---
     rec_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^Помоги выбрать \(Рекомендация\)$"), recommendation_start)],
         states={
-            STATE_ASK_BACKGROUND: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_background)],
+            STATE_ASK_BACKGROUND: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_background, block=False)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
@@ -226,17 +747,24 @@ def main() -> None:
     question_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^Задать вопрос по программам$"), question_start)],
         states={
-            STATE_ASK_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_question)],
+            STATE_ASK_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_question, block=False)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
 
     # Добавляем обработчики в приложение
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(MessageHandler(filters.Regex("^Сравнить программы$"), compare_programs_command))
+    application.add_handler(MessageHandler(filters.Regex("^Сравнить программы$"), compare_programs_command, block=False))
     application.add_handler(rec_handler)
     application.add_handler(question_handler)
+    return application
+
+def main() -> None:
+    """Запуск бота."""
+    if not check_settings():
+        return
 
+    application = build_application()
     logger.info("Бот запущен и готов к работе...")
     application.run_polling()
 
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+DATA_DIR = "data"
+CHUNKS_FILE = os.path.join(DATA_DIR, "text_chunks.json")
+CHUNK_STORE_FILE = os.path.join(DATA_DIR, "text_chunks.bin")
+
+MAGIC = b"KBCS"
+FORMAT_VERSION = 1
+# Заголовок файла: сигнатура, версия формата, смещение и длина JSON-оглавления
+HEADER = struct.Struct("<4sIQQ")
+ALIGNMENT = 8
+
+
+def chunk_faiss_id(chunk_id: str) -> int:
+    """Стабильный 63-битный идентификатор вектора чанка в индексе FAISS."""
+    return int.from_bytes(hashlib.sha256(chunk_id.encode('utf-8')).digest()[:8], 'little') & 0x7FFF_FFFF_FFFF_FFFF
+
+
+class ChunkStore:
+    """
+    Компактное хранилище чанков, открываемое только для чтения через mmap.
+
+    Тексты и chunk_id лежат сплошными UTF-8 блобами с таблицами смещений,
+    program_name и source — интернированы (в строках хранятся номера значений).
+    Страницы файла разделяются между всеми процессами бота через page cache.
+    Чанк по номеру строки достается за O(1), по идентификатору FAISS —
+    бинарным поиском по отсортированной таблице идентификаторов.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_FILE):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, toc_offset, toc_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} не является хранилищем чанков версии {FORMAT_VERSION}")
+        toc = json.loads(self._mmap[toc_offset:toc_offset + toc_length].decode('utf-8'))
+
+        self._count = toc["count"]
+        # Идентификатор сборки базы знаний, в которой записано хранилище (None — для старых файлов)
+        self.build_id = toc.get("build_id")
+        self.programs = toc["programs"]
+        self.sources = toc["sources"]
+        self._sections = toc["sections"]
+        self._text_offsets = self._array("text_offsets")
+        self._id_offsets = self._array("id_offsets")
+        self._program_codes = self._array("programs")
+        self._source_codes = self._array("sources")
+        self._sorted_faiss_ids = self._array("faiss_ids")
+        self._faiss_rows = self._array("faiss_rows")
+
+    def _array(self, name: str) -> np.ndarray:
+        offset, dtype, length = self._sections[name]
+        return np.frombuffer(self._mmap, dtype=dtype, count=length, offset=offset)
+
+    def _blob(self, name: str, start: int, end: int) -> str:
+        offset = self._sections[name][0]
+        return self._mmap[offset + start:offset + end].decode('utf-8')
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, row: int) -> dict:
+        if not 0 <= row < self._count:
+            raise IndexError(row)
+        return {
+            "source": self.sources[self._source_codes[row]],
+            "program_name": self.programs[self._program_codes[row]],
+            "text": self.text(row),
+            "chunk_id": self._blob("id_blob", int(self._id_offsets[row]), int(self._id_offsets[row + 1])),
+        }
+
+    def __iter__(self):
+        for row in range(self._count):
+            yield self[row]
+
+    def text(self, row: int) -> str:
+        return self._blob("text_blob", int(self._text_offsets[row]), int(self._text_offsets[row + 1]))
+
+    def rows_for_faiss_ids(self, faiss_ids) -> list[int]:
+        """Переводит идентификаторы из индекса FAISS в номера строк (неизвестные пропускаются)."""
+        ids = np.asarray(faiss_ids, dtype='int64')
+        found = np.searchsorted(self._sorted_faiss_ids, ids)
+        found = np.minimum(found, max(self._count - 1, 0))
+        return [int(self._faiss_rows[i]) for i, faiss_id in zip(found, ids)
+                if self._count and self._sorted_faiss_ids[i] == faiss_id]
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    @staticmethod
+    def write(chunks: list[dict], path: str = CHUNK_STORE_FILE, build_id: str | None = None) -> None:
+        """Атомарно записывает чанки в бинарное хранилище с идентификатором сборки `build_id`."""
+        programs, sources = {}, {}
+        texts = [chunk['text'].encode('utf-8') for chunk in chunks]
+        chunk_ids = [chunk['chunk_id'].encode('utf-8') for chunk in chunks]
+        faiss_ids = np.array([chunk_faiss_id(chunk['chunk_id']) for chunk in chunks], dtype='<i8')
+        order = np.argsort(faiss_ids, kind='stable')
+
+        sections = {
+            "text_offsets": _offsets(texts),
+            "id_offsets": _offsets(chunk_ids),
+            "programs": np.array([programs.setdefault(chunk['program_name'], len(programs)) for chunk in chunks], dtype='<u4'),
+            "sources": np.array([sources.setdefault(chunk['source'], len(sources)) for chunk in chunks], dtype='<u4'),
+            "faiss_ids": faiss_ids[order],
+            "faiss_rows": order.astype('<u8'),
+            "text_blob": np.frombuffer(b"".join(texts), dtype='u1'),
+            "id_blob": np.frombuffer(b"".join(chunk_ids), dtype='u1'),
+        }
+
+        toc = {"count": len(chunks), "programs": list(programs), "sources": list(sources),
+               "build_id": build_id, "sections": {}}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+            for name, array in sections.items():
+                f.write(b"\0" * (-f.tell() % ALIGNMENT))
+                toc["sections"][name] = [f.tell(), array.dtype.str, len(array)]
+                f.write(array.tobytes())
+            toc_bytes = json.dumps(toc, ensure_ascii=False).encode('utf-8')
+            toc_offset = f.tell()
+            f.write(toc_bytes)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, toc_offset, len(toc_bytes)))
+        os.replace(tmp_path, path)
+
+
+def _offsets(blobs: list[bytes]) -> np.ndarray:
+    offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    return offsets
+
+
+def convert_json(json_path: str = CHUNKS_FILE, store_path: str = CHUNK_STORE_FILE) -> int:
+    """Конвертирует text_chunks.json в бинарное хранилище. Возвращает число чанков."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        chunks = json.load(f)
+    ChunkStore.write(chunks, store_path)
+    return len(chunks)
+
+
+if __name__ == "__main__":
+    source_path = sys.argv[1] if len(sys.argv) > 1 else CHUNKS_FILE
+    target_path = sys.argv[2] if len(sys.argv) > 2 else CHUNK_STORE_FILE
+    count = convert_json(source_path, target_path)
+    print(f"Сконвертировано {count} чанков: {source_path} -> {target_path} "
+          f"({os.path.getsize(source_path)} -> {os.path.getsize(target_path)} байт).")
@@ -0,0 +1,132 @@
+import math
+import re
+
+from lexical_index import tokenize
+
+# Грубая оценка числа токенов qwen3 для русского текста без загрузки токенизатора
+CHARS_PER_TOKEN = 3.0
+# Бюджет контекста в токенах по умолчанию
+CONTEXT_TOKEN_BUDGET = 1500
+# Баланс релевантности и разнообразия в MMR: 1 — только релевантность
+MMR_LAMBDA = 0.7
+# Чанки, похожие на уже выбранный сильнее этого порога, отбрасываются как дубликаты
+DUPLICATE_THRESHOLD = 0.8
+
+SENTENCE_END = re.compile(r"[.!?…]\s")
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def text_similarity(a: set[str], b: set[str]) -> float:
+    """Коэффициент Жаккара по множествам терминов двух чанков."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def format_chunk(chunk: dict) -> str:
+    """Прежний формат фрагмента контекста: отдельный заголовок у каждого чанка."""
+    return f"Фрагмент из описания программы '{chunk['program_name']}':\n---\n{chunk['text']}\n---\n\n"
+
+
+def format_context(chunks: list[dict]) -> str:
+    """Группирует чанки по программам, чтобы заголовок программы встречался в контексте один раз."""
+    groups: dict[str, list[str]] = {}
+    for chunk in chunks:
+        groups.setdefault(chunk['program_name'], []).append(chunk['text'])
+    return "\n\n".join(f"Из описания программы '{program}':\n---\n" + "\n---\n".join(texts) + "\n---"
+                       for program, texts in groups.items())
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст до бюджета, по возможности на границе предложения."""
+    limit = int(max_tokens * CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    sentence_ends = [m.end() for m in SENTENCE_END.finditer(cut + " ")]
+    if sentence_ends and sentence_ends[-1] > limit // 2:
+        return cut[:sentence_ends[-1]].strip()
+    return cut.rsplit(" ", 1)[0].strip()
+
+
+class AssembledContext:
+    """Собранный контекст и статистика: сколько токенов он занимает и сколько сэкономлено."""
+
+    def __init__(self, text: str, chunks: list[dict], baseline_tokens: int, duplicates: int):
+        self.text = text
+        self.chunks = chunks
+        self.tokens = estimate_tokens(text)
+        self.baseline_tokens = baseline_tokens
+        self.duplicates = duplicates
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(self.baseline_tokens - self.tokens, 0)
+
+
+def assemble_context(candidates: list[dict], max_chunks: int,
+                     token_budget: int = CONTEXT_TOKEN_BUDGET,
+                     mmr_lambda: float = MMR_LAMBDA,
+                     duplicate_threshold: float = DUPLICATE_THRESHOLD,
+                     balance_programs: bool = False) -> AssembledContext:
+    """
+    Собирает контекст для промпта из кандидатов, упорядоченных по релевантности.
+
+    Чанки выбираются методом maximal marginal relevance: на каждом шаге берется
+    кандидат с лучшим сочетанием релевантности (по его месту в выдаче) и
+    непохожести на уже выбранные. Почти одинаковые чанки (например, общий текст
+    со страниц обеих программ) отбрасываются. При `balance_programs=True` ни
+    одна программа не получает больше своей доли из `max_chunks`. Общий размер
+    контекста не превышает `token_budget`.
+    """
+    baseline = "".join(format_chunk(chunk) for chunk in candidates[:max_chunks]).strip()
+    if not candidates:
+        return AssembledContext("", [], 0, 0)
+
+    terms = [set(tokenize(chunk['text'])) for chunk in candidates]
+    relevance = [1 - rank / len(candidates) for rank in range(len(candidates))]
+    programs = {chunk['program_name'] for chunk in candidates}
+    per_program_limit = math.ceil(max_chunks / len(programs)) if balance_programs else max_chunks
+
+    selected: list[int] = []
+    program_counts: dict[str, int] = {}
+    remaining = list(range(len(candidates)))
+    duplicates = 0
+    while remaining and len(selected) < max_chunks:
+        best, best_score = None, -math.inf
+        for i in list(remaining):
+            redundancy = max((text_similarity(terms[i], terms[j]) for j in selected), default=0.0)
+            if redundancy >= duplicate_threshold:
+                remaining.remove(i)
+                duplicates += 1
+                continue
+            if program_counts.get(candidates[i]['program_name'], 0) >= per_program_limit:
+                continue
+            score = mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        if best is None:
+            if remaining and per_program_limit < max_chunks:
+                # У других программ кандидатов не осталось — добираем без ограничения
+                per_program_limit = max_chunks
+                continue
+            break
+        remaining.remove(best)
+        chunk = candidates[best]
+        trial = [candidates[j] for j in selected] + [chunk]
+        if estimate_tokens(format_context(trial)) > token_budget:
+            if selected:
+                continue
+            # Даже самый релевантный чанк не влезает в бюджет — берем его начало
+            overhead = estimate_tokens(format_context([dict(chunk, text="")]))
+            chunk = dict(chunk, text=truncate_to_tokens(chunk['text'], token_budget - overhead))
+            candidates = candidates[:best] + [chunk] + candidates[best + 1:]
+        selected.append(best)
+        program_counts[chunk['program_name']] = program_counts.get(chunk['program_name'], 0) + 1
+
+    # В промпте чанки идут в порядке релевантности
+    chosen = [candidates[i] for i in sorted(selected)]
+    return AssembledContext(format_context(chosen), chosen, estimate_tokens(baseline), duplicates)
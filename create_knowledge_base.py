@@ -1,34 +1,175 @@
+import argparse
+import asyncio
 import json
-import requests
+import time
+import uuid
 import numpy as np
 import faiss
 import os
 
-OLLAMA_API_URL = "http://localhost:11434/api/embeddings"
-EMBEDDING_MODEL = "nomic-embed-text"
+from chunk_store import CHUNK_STORE_FILE, ChunkStore
+from embedding_cache import EmbeddingCache, EMBEDDING_CACHE_PATH
+from knowledge_base import (
+    BM25_INDEX_FILE,
+    DEFAULT_INDEX_SPEC,
+    INDEX_MANIFEST_FILE,
+    INDEX_META_FILE,
+    PROGRAM_PROFILES_FILE,
+    ProgramProfiles,
+    build_index,
+    chunk_faiss_id,
+    chunk_text_hash,
+    evaluate_index,
+    load_index_manifest,
+    load_index_meta,
+    parse_index_spec,
+    save_index,
+    save_json,
+    supports_incremental_update,
+    update_index,
+)
+from lexical_index import BM25Index
+from ollama_client import AsyncOllamaClient, OllamaError, OllamaUnavailableError, OLLAMA_API_URL, EMBEDDING_MODEL
+
 DATA_DIR = "data"
 CHUNKS_FILE = os.path.join(DATA_DIR, "text_chunks.json")
 FAISS_INDEX_FILE = os.path.join(DATA_DIR, "faiss_index.bin")
 
-def get_embedding(text: str) -> np.ndarray:
-    """Получает эмбеддинг для текста через API Ollama."""
+# Настройки пакетного получения эмбеддингов
+EMBED_BATCH_SIZE = 32  # Сколько чанков отправляется в одном запросе к /api/embed
+EMBED_MAX_IN_FLIGHT = 4  # Сколько пакетов обрабатывается одновременно
+EMBED_BATCH_TIMEOUT = 120
+
+
+async def _embed_chunk_batch(client: AsyncOllamaClient, semaphore: asyncio.Semaphore,
+                             texts: list[str]) -> list[np.ndarray | None]:
+    """
+    Возвращает эмбеддинги пакета в исходном порядке. Если пакет так и не удалось
+    обработать (временные ошибки клиент уже повторил), чанки отправляются
+    по одному, и None ставится только для проблемных. Если Ollama недоступен
+    (разомкнут предохранитель), OllamaUnavailableError пробрасывается: иначе
+    все оставшиеся чанки молча выпали бы из базы.
+    """
+    async with semaphore:
+        try:
+            return list(await client.embed_batch(texts, EMBEDDING_MODEL, timeout=EMBED_BATCH_TIMEOUT))
+        except OllamaUnavailableError:
+            raise
+        except OllamaError as e:
+            print(f"Ошибка при получении эмбеддингов пакета: {e}")
+            if len(texts) == 1:
+                return [None]
+
+        results = []
+        for text in texts:
+            try:
+                results.append((await client.embed_batch([text], EMBEDDING_MODEL, timeout=EMBED_BATCH_TIMEOUT))[0])
+            except OllamaUnavailableError:
+                raise
+            except OllamaError:
+                results.append(None)
+        return results
+
+
+async def embed_texts(texts: list[str]) -> list[np.ndarray | None]:
+    """
+    Получает эмбеддинги для всех текстов пакетами через /api/embed,
+    держа в работе не более EMBED_MAX_IN_FLIGHT запросов одновременно.
+    Результат выровнен по индексам с `texts`: None — для чанков с ошибкой.
+    """
+    client = AsyncOllamaClient(OLLAMA_API_URL, max_connections=EMBED_MAX_IN_FLIGHT,
+                               max_keepalive_connections=EMBED_MAX_IN_FLIGHT)
+    semaphore = asyncio.Semaphore(EMBED_MAX_IN_FLIGHT)
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    done = 0
+
+    async def run_batch(batch: list[str]) -> list[np.ndarray | None]:
+        nonlocal done
+        result = await _embed_chunk_batch(client, semaphore, batch)
+        done += len(batch)
+        print(f"Обработано чанков: {done}/{len(texts)}...")
+        return result
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(run_batch(batch)) for batch in batches]
     try:
-        payload = {
-            "model": EMBEDDING_MODEL,
-            "prompt": text
-        }
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=30)
-        response.raise_for_status()
-        embedding = response.json().get("embedding")
-        return np.array(embedding, dtype='float32')
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при получении эмбеддинга: {e}")
+        batch_results = await asyncio.gather(*tasks)
+    finally:
+        # При ошибке остальные пакеты больше не нужны
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.aclose()
+    elapsed = time.perf_counter() - started
+
+    print(f"Эмбеддинги получены за {elapsed:.1f} с ({len(texts) / max(elapsed, 1e-9):.1f} чанков/с).")
+    return [embedding for batch in batch_results for embedding in batch]
+
+
+def get_chunk_embeddings(texts: list[str], cache: EmbeddingCache | None) -> list[np.ndarray | None]:
+    """
+    Возвращает эмбеддинги чанков: из кэша, если текст уже встречался,
+    и через Ollama — только для новых или измененных чанков.
+    """
+    embeddings = cache.get_many(EMBEDDING_MODEL, texts) if cache else [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    print(f"Эмбеддингов в кэше: {len(texts) - len(missing)}, требуется получить: {len(missing)}.")
+    if not missing:
+        return embeddings
+
+    fresh = asyncio.run(embed_texts([texts[i] for i in missing]))
+    for i, embedding in zip(missing, fresh):
+        embeddings[i] = embedding
+        if cache is not None and embedding is not None:
+            cache.put(EMBEDDING_MODEL, texts[i], embedding)
+    return embeddings
+
+
+def load_previous_index(index_spec: str | None):
+    """
+    Возвращает (индекс, метаданные, манифест) прошлой сборки для инкрементального
+    обновления или None, если базу нужно собрать заново.
+    """
+    manifest = load_index_manifest(INDEX_MANIFEST_FILE)
+    if manifest is None or not os.path.exists(FAISS_INDEX_FILE):
+        print("Предыдущая сборка с идентификаторами чанков не найдена, база будет собрана заново.")
+        return None
+    meta = load_index_meta(INDEX_META_FILE)
+    if not supports_incremental_update(meta):
+        print(f"Индекс '{meta.get('type')}' не поддерживает инкрементальное обновление, база будет собрана заново.")
         return None
-    except (KeyError, TypeError):
-        print("Не удалось извлечь эмбеддинг из ответа Ollama.")
+    if (index_spec and parse_index_spec(index_spec)[0] != meta["type"]) or meta.get("embedding_model") != EMBEDDING_MODEL:
+        print("Тип индекса или модель эмбеддингов изменились, база будет собрана заново.")
         return None
+    index = faiss.read_index(FAISS_INDEX_FILE)
+    if meta["type"] == "ivfpq" and isinstance(index, faiss.IndexIDMap2):
+        # Прежние сборки оборачивали IVF в IndexIDMap2, который после удаления путает идентификаторы
+        print("Индекс IVF-PQ собран в старом формате, база будет собрана заново.")
+        return None
+    if index.ntotal != len(manifest):
+        print("Индекс не соответствует манифесту чанков, база будет собрана заново.")
+        return None
+    return index, meta, manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Создание векторной базы знаний FAISS из text_chunks.json.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="не использовать кэш эмбеддингов и получить все эмбеддинги заново")
+    parser.add_argument("--prune-cache", action="store_true",
+                        help="удалить из кэша эмбеддинги чанков, которых больше нет в text_chunks.json")
+    parser.add_argument("--index",
+                        help="тип индекса FAISS: flat (косинусная близость, по умолчанию), flat-l2, "
+                             "hnsw[:M=32,efConstruction=200,efSearch=64] или "
+                             "ivfpq[:nlist=256,m=16,nbits=8,nprobe=16]")
+    parser.add_argument("--incremental", action="store_true",
+                        help="не пересобирать индекс, а удалить из него исчезнувшие и измененные чанки "
+                             "и добавить новые (по chunk_id)")
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
     print("Запуск создания базы знаний...")
 
     # 1. Загрузка текстовых чанков
@@ -38,47 +179,123 @@ def main():
     except FileNotFoundError:
         print(f"Файл {CHUNKS_FILE} не найден. Сначала запустите parser.py.")
         return
-    
+
     if not chunks:
         print("Нет данных для создания базы знаний.")
         return
 
     print(f"Загружено {len(chunks)} текстовых чанков.")
 
-    # 2. Получение эмбеддингов для каждого чанка
-    embeddings = []
-    valid_chunks = [] # Сохраняем только те чанки, для которых удалось создать эмбеддинг
-    for i, chunk_data in enumerate(chunks):
-        print(f"Обработка чанка {i+1}/{len(chunks)}...")
-        embedding = get_embedding(chunk_data['text'])
-        if embedding is not None:
-            embeddings.append(embedding)
-            valid_chunks.append(chunk_data)
-        else:
+    try:
+        parse_index_spec(args.index or DEFAULT_INDEX_SPEC)
+    except ValueError as e:
+        print(f"Некорректное описание индекса: {e}")
+        return
+
+    # 2. Какие чанки нужно проиндексировать: все или только новые и измененные
+    manifest = {chunk_data['chunk_id']: chunk_text_hash(chunk_data['text']) for chunk_data in chunks}
+    previous = load_previous_index(args.index) if args.incremental else None
+    if previous:
+        index, meta, previous_manifest = previous
+        to_embed = [chunk_data for chunk_data in chunks
+                    if previous_manifest.get(chunk_data['chunk_id']) != manifest[chunk_data['chunk_id']]]
+        removed_ids = [chunk_faiss_id(chunk_id) for chunk_id, text_hash in previous_manifest.items()
+                       if manifest.get(chunk_id) != text_hash]
+        print(f"Инкрементальное обновление: {len(to_embed)} новых или измененных чанков, "
+              f"{len(removed_ids)} векторов к удалению.")
+        if not to_embed and not removed_ids:
+            print("\nБаза знаний не изменилась, файлы индекса не перезаписываются.")
+            return
+    else:
+        to_embed = chunks
+
+    # 3. Получение эмбеддингов: из кэша или пакетами через Ollama. Эмбеддинги
+    # неизмененных чанков тоже нужны (для профилей программ): при инкрементальном
+    # обновлении они берутся из кэша, а без кэша получаются заново
+    texts = [chunk_data['text'] for chunk_data in chunks]
+    cache = None if args.no_cache else EmbeddingCache(EMBEDDING_CACHE_PATH)
+    try:
+        chunk_embeddings = get_chunk_embeddings(texts, cache)
+    except OllamaUnavailableError as e:
+        # Неполная база хуже прежней: работающий бот сразу подхватил бы ее
+        print(f"{e}. Сборка прервана, файлы базы знаний не изменены.")
+        return
+    if cache is not None:
+        if args.prune_cache:
+            all_texts = [chunk_data['text'] for chunk_data in chunks]
+            print(f"Удалено устаревших записей из кэша эмбеддингов: {cache.prune(EMBEDDING_MODEL, all_texts)}.")
+        cache.save()
+
+    failed = set()  # Чанки, для которых не удалось создать эмбеддинг, в базу не попадут
+    for chunk_data, embedding in zip(chunks, chunk_embeddings):
+        if embedding is None:
+            failed.add(chunk_data['chunk_id'])
             print(f"Пропуск чанка из-за ошибки с эмбеддингом: {chunk_data['chunk_id']}")
-            
-    if not embeddings:
+    valid_chunks = [chunk_data for chunk_data in chunks if chunk_data['chunk_id'] not in failed]
+
+    if not valid_chunks:
         print("Не удалось создать ни одного эмбеддинга. Прерывание.")
         return
-        
-    # Преобразование списка эмбеддингов в numpy-массив
-    embeddings_np = np.array(embeddings)
-    
-    # 3. Создание и обучение индекса FAISS
-    dimension = embeddings_np.shape[1]  # Размерность векторов
-    index = faiss.IndexFlatL2(dimension)   # Используем L2 расстояние для поиска
-    index.add(embeddings_np)
-    
-    print(f"\nСоздан FAISS индекс с {index.ntotal} векторами размерности {dimension}.")
-    
-    # 4. Сохранение индекса и валидных чанков
-    faiss.write_index(index, FAISS_INDEX_FILE)
-    # Перезаписываем файл чанков, чтобы он соответствовал индексам в FAISS
-    with open(CHUNKS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(valid_chunks, f, ensure_ascii=False, indent=4)
-        
-    print(f"Индекс сохранен в: {FAISS_INDEX_FILE}")
-    print(f"Соответствующие чанки обновлены в: {CHUNKS_FILE}")
+
+    # Эмбеддинги и идентификаторы выровнены по строкам valid_chunks
+    embeddings_np = np.array([embedding for embedding in chunk_embeddings if embedding is not None], dtype='float32')
+    embedded_ids = np.array([chunk_faiss_id(chunk_data['chunk_id']) for chunk_data in valid_chunks], dtype='int64')
+
+    # 4. Создание (или обновление) индекса FAISS
+    started = time.perf_counter()
+    if previous:
+        # Неизмененный чанк без эмбеддинга тоже убираем из индекса
+        removed_ids += [chunk_faiss_id(chunk_id) for chunk_id in failed
+                        if previous_manifest.get(chunk_id) == manifest[chunk_id]]
+        changed = {chunk_data['chunk_id'] for chunk_data in to_embed}
+        added = [row for row, chunk_data in enumerate(valid_chunks) if chunk_data['chunk_id'] in changed]
+        update_index(index, meta, np.array(removed_ids, dtype='int64'), embeddings_np[added], embedded_ids[added])
+        meta["update_seconds"] = time.perf_counter() - started
+        print(f"\nИндекс '{meta['type']}' обновлен за {meta['update_seconds']:.2f} с: "
+              f"удалено {len(removed_ids)}, добавлено {len(added)}, всего {index.ntotal} векторов.")
+    else:
+        index, meta = build_index(embeddings_np, args.index or DEFAULT_INDEX_SPEC, ids=embedded_ids)
+        meta["embedding_model"] = EMBEDDING_MODEL
+        meta["build_seconds"] = time.perf_counter() - started
+
+        print(f"\nСоздан FAISS индекс '{meta['type']}' с {index.ntotal} векторами размерности {meta['dimension']} "
+              f"за {meta['build_seconds']:.2f} с.")
+
+    # Сравнение с точным поиском: насколько индекс теряет в полноте и выигрывает в скорости.
+    # После инкрементального обновления отчет строится по эмбеддингам всех чанков из кэша
+    report = evaluate_index(index, embeddings_np, meta, ids=embedded_ids)
+    meta["report"] = report
+    print(f"Recall@{report['k']} относительно точного поиска: {report['recall']:.3f} "
+          f"(по {report['queries']} запросам); время поиска: {report['latency_ms']:.3f} мс/запрос "
+          f"против {report['exact_latency_ms']:.3f} мс/запрос у точного индекса.")
+
+    # 5. Лексический индекс BM25 по тем же чанкам (номера документов совпадают со строками хранилища)
+    started = time.perf_counter()
+    bm25_index = BM25Index.build([chunk_data['text'] for chunk_data in valid_chunks])
+    print(f"Создан индекс BM25 ({len(bm25_index.terms)} терминов) за {time.perf_counter() - started:.2f} с.")
+
+    # 6. Профили программ для рекомендаций: центроиды эмбеддингов чанков каждой программы
+    profiles = ProgramProfiles.build(embeddings_np, [chunk_data['program_name'] for chunk_data in valid_chunks])
+    print(f"Построены профили {len(profiles)} программ для рекомендаций.")
+
+    # 7. Сохранение индексов, профилей, метаданных и валидных чанков. Каждый файл заменяется
+    # атомарно и помечается идентификатором сборки, а чанки записываются последними:
+    # работающий бот загружает базу, только когда у всех файлов один и тот же build_id
+    build_id = uuid.uuid4().hex[:16]
+    meta["build_id"] = bm25_index.build_id = profiles.build_id = build_id
+    bm25_index.save(f"{BM25_INDEX_FILE}.tmp")
+    os.replace(f"{BM25_INDEX_FILE}.tmp", BM25_INDEX_FILE)
+    profiles.save(PROGRAM_PROFILES_FILE)
+    save_json({chunk_data['chunk_id']: manifest[chunk_data['chunk_id']] for chunk_data in valid_chunks},
+              INDEX_MANIFEST_FILE, indent=None)
+    save_index(index, meta, FAISS_INDEX_FILE, INDEX_META_FILE)
+    # Проиндексированные чанки сохраняются в бинарное хранилище, из которого их читает бот
+    ChunkStore.write(valid_chunks, CHUNK_STORE_FILE, build_id=build_id)
+
+    print(f"Индекс сохранен в: {FAISS_INDEX_FILE} (метаданные: {INDEX_META_FILE})")
+    print(f"Индекс BM25 сохранен в: {BM25_INDEX_FILE}")
+    print(f"Профили программ сохранены в: {PROGRAM_PROFILES_FILE}")
+    print(f"Проиндексированные чанки сохранены в: {CHUNK_STORE_FILE}")
     print("\nБаза знаний успешно создана!")
 
 
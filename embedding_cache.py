@@ -0,0 +1,115 @@
+import hashlib
+import os
+
+import numpy as np
+
+DATA_DIR = "data"
+EMBEDDING_CACHE_PATH = os.path.join(DATA_DIR, "embedding_cache")
+
+KEY_SIZE = hashlib.sha256().digest_size
+
+
+class EmbeddingCache:
+    """
+    Постоянный кэш эмбеддингов, адресуемый по содержимому.
+
+    Ключ — sha256 от (имя модели, текст чанка), поэтому любой измененный чанк
+    получает новый ключ. На диске кэш хранится в двух файлах:
+    `<path>.npy` — матрица float32 (открывается через memory-map),
+    `<path>.keys` — ключи строк матрицы подряд по KEY_SIZE байт.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self.vectors_file = f"{path}.npy"
+        self.keys_file = f"{path}.keys"
+        self._rows: dict[bytes, int] = {}
+        self._vectors: np.ndarray | None = None
+        self._pending: dict[bytes, np.ndarray] = {}
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> bytes:
+        return hashlib.sha256(model.encode('utf-8') + b"\0" + text.encode('utf-8')).digest()
+
+    def _load(self) -> None:
+        if not (os.path.exists(self.vectors_file) and os.path.exists(self.keys_file)):
+            return
+        with open(self.keys_file, 'rb') as f:
+            raw_keys = f.read()
+        vectors = np.load(self.vectors_file, mmap_mode='r')
+        # Файлы записываются по очереди; при рассогласовании кэш считается пустым
+        if len(raw_keys) % KEY_SIZE or len(raw_keys) // KEY_SIZE != len(vectors):
+            print("Файлы кэша эмбеддингов не согласованы, кэш будет пересоздан.")
+            return
+        self._vectors = vectors
+        self._rows = {raw_keys[i:i + KEY_SIZE]: i // KEY_SIZE for i in range(0, len(raw_keys), KEY_SIZE)}
+
+    def __len__(self) -> int:
+        return len(self._rows) + sum(1 for key in self._pending if key not in self._rows)
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        key = self.make_key(model, text)
+        if key in self._pending:
+            return self._pending[key]
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        return np.array(self._vectors[row], dtype='float32')
+
+    def get_many(self, model: str, texts: list[str]) -> list[np.ndarray | None]:
+        return [self.get(model, text) for text in texts]
+
+    def put(self, model: str, text: str, vector: np.ndarray) -> None:
+        self._pending[self.make_key(model, text)] = np.asarray(vector, dtype='float32')
+
+    def prune(self, model: str, texts: list[str]) -> int:
+        """
+        Удаляет из кэша все записи, кроме эмбеддингов `texts` для модели `model`.
+        Возвращает число удаленных записей; изменения попадают на диск при save().
+        """
+        keep = {self.make_key(model, text) for text in texts}
+        evicted = [key for key in self._rows if key not in keep]
+        for key in evicted:
+            del self._rows[key]
+        evicted_pending = [key for key in self._pending if key not in keep]
+        for key in evicted_pending:
+            del self._pending[key]
+        self._dirty = self._dirty or bool(evicted)
+        return len(evicted) + len(evicted_pending)
+
+    def save(self) -> None:
+        """Атомарно записывает кэш на диск (через временные файлы и os.replace)."""
+        if not self._pending and not self._dirty:
+            return
+        keys = [key for key in self._rows if key not in self._pending]
+        rows = [self._rows[key] for key in keys]
+        stored = np.asarray(self._vectors[rows], dtype='float32') if rows else None
+        fresh = list(self._pending.values())
+
+        # Смена размерности (другая модель) — старые векторы несовместимы с новыми
+        if stored is not None and fresh and stored.shape[1] != len(fresh[0]):
+            print("Размерность эмбеддингов изменилась, старые записи кэша удалены.")
+            keys, stored = [], None
+
+        keys += list(self._pending)
+        parts = ([stored] if stored is not None else []) + ([np.stack(fresh)] if fresh else [])
+        if not parts:
+            matrix = np.zeros((0, 0), dtype='float32')
+        else:
+            matrix = np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+        # Отпускаем memory-map старого файла перед его заменой
+        self._vectors = None
+        os.makedirs(os.path.dirname(self.vectors_file) or ".", exist_ok=True)
+        with open(f"{self.vectors_file}.tmp", 'wb') as f:
+            np.save(f, matrix)
+        with open(f"{self.keys_file}.tmp", 'wb') as f:
+            f.write(b"".join(keys))
+        os.replace(f"{self.vectors_file}.tmp", self.vectors_file)
+        os.replace(f"{self.keys_file}.tmp", self.keys_file)
+
+        self._pending = {}
+        self._rows = {}
+        self._dirty = False
+        self._load()
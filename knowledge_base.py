@@ -0,0 +1,377 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import faiss
+import numpy as np
+
+from chunk_store import CHUNK_STORE_FILE, ChunkStore, chunk_faiss_id
+from lexical_index import BM25Index
+
+logger = logging.getLogger(__name__)
+
+# Пути к файлам базы знаний
+DATA_DIR = "data"
+CHUNKS_FILE = os.path.join(DATA_DIR, "text_chunks.json")
+FAISS_INDEX_FILE = os.path.join(DATA_DIR, "faiss_index.bin")
+INDEX_META_FILE = os.path.join(DATA_DIR, "faiss_index.meta.json")
+BM25_INDEX_FILE = os.path.join(DATA_DIR, "bm25_index.npz")
+# Хэши текстов проиндексированных чанков: по ним инкрементальная сборка находит изменения
+INDEX_MANIFEST_FILE = os.path.join(DATA_DIR, "faiss_index.ids.json")
+# Профили программ (центроиды эмбеддингов их чанков) для рекомендаций
+PROGRAM_PROFILES_FILE = os.path.join(DATA_DIR, "program_profiles.npz")
+
+# Типы индексов и их параметры по умолчанию. Все типы, кроме flat-l2, работают
+# с нормализованными векторами и скалярным произведением (косинусная близость).
+DEFAULT_INDEX_SPEC = "flat"
+INDEX_DEFAULTS = {
+    "flat-l2": {},
+    "flat": {},
+    "hnsw": {"M": 32, "efConstruction": 200, "efSearch": 64},
+    "ivfpq": {"nlist": 256, "m": 16, "nbits": 8, "nprobe": 16},
+}
+# Параметры, которые задаются при поиске, а не при построении индекса
+SEARCH_PARAMS = ("efSearch", "nprobe")
+
+# Метаданные индекса, созданного до появления файла метаданных
+LEGACY_INDEX_META = {"type": "flat-l2", "normalize": False, "params": {}}
+
+
+def kb_files() -> tuple[str, str]:
+    """Файлы, из которых бот загружает базу: индекс и хранилище чанков (или JSON для старых баз)."""
+    return FAISS_INDEX_FILE, CHUNK_STORE_FILE if os.path.exists(CHUNK_STORE_FILE) else CHUNKS_FILE
+
+
+def get_kb_version(paths: tuple[str, ...] | None = None) -> str | None:
+    """
+    Возвращает версию базы знаний — отпечаток размера и времени изменения
+    файлов индекса и чанков. Любая пересборка базы меняет версию.
+    Если какого-то файла нет, возвращает None.
+    """
+    digest = hashlib.sha256()
+    for path in paths or kb_files():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def chunk_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_index_spec(spec: str) -> tuple[str, dict]:
+    """
+    Разбирает описание индекса вида "hnsw" или "ivfpq:nlist=1024,m=32".
+    Возвращает тип индекса и его параметры (с подставленными значениями по умолчанию).
+    """
+    name, _, raw_params = spec.partition(":")
+    name = name.strip().lower()
+    if name not in INDEX_DEFAULTS:
+        raise ValueError(f"Неизвестный тип индекса '{name}'. Доступны: {', '.join(INDEX_DEFAULTS)}.")
+    params = dict(INDEX_DEFAULTS[name])
+    for item in filter(None, raw_params.split(",")):
+        key, _, value = item.partition("=")
+        if key.strip() not in params:
+            raise ValueError(f"Неизвестный параметр '{key.strip()}' для индекса '{name}'.")
+        params[key.strip()] = int(value)
+    return name, params
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Возвращает копию векторов, нормализованных по L2 (для косинусной близости)."""
+    vectors = np.array(vectors, dtype='float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def build_index(embeddings: np.ndarray, spec: str = DEFAULT_INDEX_SPEC,
+                ids: np.ndarray | None = None) -> tuple[faiss.Index, dict]:
+    """
+    Строит индекс FAISS по описанию `spec` (обучая его, если нужно).
+    Если заданы `ids`, векторы добавляются под этими идентификаторами
+    (IndexIDMap2 или собственные идентификаторы IVF), что позволяет потом
+    точечно удалять и добавлять чанки.
+    Возвращает индекс и метаданные, которые сохраняются рядом с ним.
+    """
+    index_type, params = parse_index_spec(spec)
+    normalize = index_type != "flat-l2"
+    vectors = normalize_vectors(embeddings) if normalize else np.asarray(embeddings, dtype='float32')
+    count, dimension = vectors.shape
+
+    if index_type == "ivfpq":
+        # FAISS обучает k-means на ~39 векторах на центроид: для IVF центроидов nlist
+        # (его уменьшаем под объем данных), для каждого подквантователя PQ — 2^nbits
+        params["nlist"] = max(1, min(params["nlist"], count // 39))
+        if count < 39 * max(params["nlist"], 2 ** params["nbits"]) or dimension % params["m"]:
+            print(f"Недостаточно данных для IVF-PQ ({count} векторов, размерность {dimension}), "
+                  f"используется точный индекс.")
+            index_type, params = "flat", {}
+
+    if index_type == "flat-l2":
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == "flat":
+        index = faiss.IndexFlatIP(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["efConstruction"]
+    else:
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, params["nlist"], params["m"], params["nbits"],
+                                 faiss.METRIC_INNER_PRODUCT)
+        started = time.perf_counter()
+        index.train(vectors)
+        print(f"Индекс IVF-PQ обучен за {time.perf_counter() - started:.2f} с.")
+
+    if ids is not None:
+        # IVF хранит идентификаторы в инвертированных списках сам и корректно их удаляет;
+        # IndexIDMap2 подходит только для индексов, которые при удалении сдвигают векторы (flat)
+        if index_type != "ivfpq":
+            index = faiss.IndexIDMap2(index)
+        index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+    else:
+        index.add(vectors)
+    meta = {"type": index_type, "normalize": normalize, "params": params,
+            "dimension": dimension, "ntotal": int(index.ntotal), "id_mapped": ids is not None}
+    apply_search_params(index, meta)
+    return index, meta
+
+
+def apply_search_params(index: faiss.Index, meta: dict, overrides: dict | None = None) -> None:
+    """Устанавливает параметры поиска (efSearch/nprobe) из метаданных и переопределений."""
+    params = {key: value for key, value in meta.get("params", {}).items() if key in SEARCH_PARAMS}
+    params.update({key: value for key, value in (overrides or {}).items() if key in params and value})
+    for key, value in params.items():
+        faiss.ParameterSpace().set_index_parameter(index, key, value)
+
+
+def index_mmap_flags(meta: dict) -> int:
+    """
+    Флаги faiss.read_index, с которыми данные индекса не читаются в память
+    процесса, а отображаются из файла (mmap) только для чтения. Страницы
+    файла общие для всех процессов, открывших индекс. Для IVF так
+    отображаются инвертированные списки, для остальных типов — векторы.
+    """
+    if meta.get("type") == "ivfpq":
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def prepare_queries(vectors: np.ndarray, meta: dict) -> np.ndarray:
+    """Приводит эмбеддинги запросов к виду, в котором строился индекс."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype='float32'))
+    return normalize_vectors(vectors) if meta.get("normalize") else vectors
+
+
+def update_index(index: faiss.Index, meta: dict, remove_ids: np.ndarray,
+                 add_embeddings: np.ndarray, add_ids: np.ndarray) -> None:
+    """Инкрементально удаляет и добавляет векторы в индексе с идентификаторами."""
+    if len(remove_ids):
+        index.remove_ids(np.asarray(remove_ids, dtype='int64'))
+    if len(add_ids):
+        vectors = normalize_vectors(add_embeddings) if meta["normalize"] else np.asarray(add_embeddings, dtype='float32')
+        index.add_with_ids(vectors, np.asarray(add_ids, dtype='int64'))
+    meta["ntotal"] = int(index.ntotal)
+
+
+def supports_incremental_update(meta: dict) -> bool:
+    """HNSW в FAISS не поддерживает удаление векторов, его всегда пересобираем целиком."""
+    return bool(meta.get("id_mapped")) and meta.get("type") != "hnsw"
+
+
+def evaluate_index(index: faiss.Index, embeddings: np.ndarray, meta: dict,
+                   k: int = 10, sample_size: int = 200, ids: np.ndarray | None = None) -> dict:
+    """
+    Сравнивает индекс с точным перебором: recall@k и среднее время поиска
+    на запрос. В качестве запросов используется выборка векторов из самой базы.
+    Для индекса с идентификаторами нужно передать `ids` векторов `embeddings`.
+    """
+    vectors = prepare_queries(embeddings, meta)
+    exact = faiss.IndexFlatL2(vectors.shape[1]) if meta["type"] == "flat-l2" else faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)
+    queries = vectors[sample]
+    k = min(k, len(vectors))
+
+    started = time.perf_counter()
+    _, exact_ids = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    started = time.perf_counter()
+    _, found_ids = index.search(queries, k)
+    index_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    if ids is not None:
+        exact_ids = np.asarray(ids, dtype='int64')[exact_ids]
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(found_ids, exact_ids))
+    return {"k": k, "queries": len(queries), "recall": hits / (k * len(queries)),
+            "latency_ms": index_ms, "exact_latency_ms": exact_ms}
+
+
+def save_index(index: faiss.Index, meta: dict,
+               index_path: str = FAISS_INDEX_FILE, meta_path: str = INDEX_META_FILE) -> None:
+    """Атомарно сохраняет индекс и его метаданные (работающий бот не увидит половину файла)."""
+    with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    faiss.write_index(index, f"{index_path}.tmp")
+    os.replace(f"{meta_path}.tmp", meta_path)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+class ProgramProfiles:
+    """
+    Профили программ: нормализованные центроиды эмбеддингов чанков каждой
+    программы. Близость эмбеддинга к каждой программе считается одним
+    умножением матрицы профилей на вектор.
+    """
+
+    def __init__(self, names: list[str], vectors: np.ndarray, build_id: str | None = None):
+        self.names = names
+        self.vectors = vectors
+        self.build_id = build_id
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, program_names: list[str]) -> "ProgramProfiles":
+        names = sorted(set(program_names))
+        labels = np.array([names.index(name) for name in program_names])
+        vectors = normalize_vectors(embeddings)
+        centroids = np.zeros((len(names), vectors.shape[1]), dtype='float32')
+        np.add.at(centroids, labels, vectors)
+        return cls(names, normalize_vectors(centroids))
+
+    def scores(self, embedding: np.ndarray) -> np.ndarray:
+        """Косинусная близость эмбеддинга к профилю каждой программы."""
+        return self.vectors @ normalize_vectors(np.atleast_2d(embedding))[0]
+
+    def save(self, path: str = PROGRAM_PROFILES_FILE) -> None:
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, names=np.array(self.names, dtype=str), vectors=self.vectors,
+                     build_id=np.array(self.build_id or ""))
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str = PROGRAM_PROFILES_FILE) -> "ProgramProfiles":
+        with np.load(path) as data:
+            return cls(data["names"].tolist(), data["vectors"],
+                       str(data["build_id"]) or None if "build_id" in data else None)
+
+
+def save_json(data, path: str, indent: int | None = 4) -> None:
+    """Атомарно записывает JSON-файл."""
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_index_manifest(path: str = INDEX_MANIFEST_FILE) -> dict[str, str] | None:
+    """Возвращает {chunk_id: хэш текста} для проиндексированных чанков или None."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load_index_meta(meta_path: str = INDEX_META_FILE) -> dict:
+    """Читает метаданные индекса; для старых баз без файла метаданных — точный L2-индекс."""
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(LEGACY_INDEX_META)
+
+
+class KnowledgeBase:
+    """
+    Загруженная база знаний: индекс FAISS, чанки, индекс BM25, профили программ и версия.
+
+    После загрузки объект не меняется; при обновлении файлов бот загружает
+    новый объект и подменяет ссылку на него, а запросы, которые уже
+    выполняются, дорабатывают со старым.
+    """
+
+    def __init__(self, index: faiss.Index, meta: dict, chunks: ChunkStore | list[dict],
+                 bm25: BM25Index | None, version: str | None, profiles: ProgramProfiles | None = None):
+        self.index = index
+        self.meta = meta
+        self.chunks = chunks
+        self.bm25 = bm25
+        self.version = version
+        self.profiles = profiles
+        # Для базы из text_chunks.json (без бинарного хранилища) строим таблицу id -> строка в памяти
+        self.positions = ({chunk_faiss_id(chunk['chunk_id']): i for i, chunk in enumerate(chunks)}
+                          if meta.get("id_mapped") and not isinstance(chunks, ChunkStore) else None)
+
+    @classmethod
+    def load(cls, search_overrides: dict | None = None, mmap: bool = False) -> "KnowledgeBase":
+        """
+        Загружает базу знаний с диска. Бросает исключение, если файлы
+        отсутствуют или не согласованы между собой (например, идет пересборка):
+        индекс FAISS и хранилище чанков должны быть записаны одной сборкой
+        (одинаковый build_id). Индекс BM25 и профили программ из другой
+        сборки не загружаются.
+        С `mmap=True` индекс FAISS отображается в память только для чтения
+        (см. index_mmap_flags) и не копируется в каждый процесс.
+        """
+        files = kb_files()
+        version = get_kb_version(files)
+        meta = load_index_meta(INDEX_META_FILE)
+        index = faiss.read_index(FAISS_INDEX_FILE, index_mmap_flags(meta) if mmap else 0)
+        apply_search_params(index, meta, search_overrides)
+        if files[1] == CHUNK_STORE_FILE:
+            chunks = ChunkStore(CHUNK_STORE_FILE)
+        else:
+            with open(CHUNKS_FILE, 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+        if len(chunks) != index.ntotal:
+            raise ValueError(f"в индексе {index.ntotal} векторов, а чанков {len(chunks)}")
+        build_id = meta.get("build_id")
+        # У text_chunks.json нет идентификатора сборки, его согласованность проверяется только по числу чанков
+        if isinstance(chunks, ChunkStore) and chunks.build_id != build_id:
+            raise ValueError(f"индекс FAISS из сборки {build_id}, а хранилище чанков — из сборки {chunks.build_id}")
+
+        # Лексический индекс не обязателен: без него поиск остается чисто векторным
+        try:
+            bm25 = BM25Index.load(BM25_INDEX_FILE)
+            if len(bm25) != len(chunks):
+                raise ValueError(f"в индексе BM25 {len(bm25)} документов, а чанков {len(chunks)}")
+            if bm25.build_id != build_id:
+                raise ValueError(f"индекс BM25 из другой сборки ({bm25.build_id})")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Лексический индекс BM25 не загружен, используется только векторный поиск: {e}")
+            bm25 = None
+
+        # Без профилей программ рекомендации строятся по ключевым словам
+        try:
+            profiles = ProgramProfiles.load(PROGRAM_PROFILES_FILE)
+            if profiles.build_id != build_id:
+                raise ValueError(f"профили из другой сборки ({profiles.build_id})")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Профили программ не загружены, рекомендации будут по ключевым словам: {e}")
+            profiles = None
+
+        if get_kb_version(files) != version:
+            raise ValueError("файлы базы знаний изменились во время загрузки")
+        return cls(index, meta, chunks, bm25, version, profiles)
+
+    def search_vectors_batch(self, query_embeddings: np.ndarray, top_k: int) -> list[list[int]]:
+        """Ищет ближайшие чанки сразу для нескольких запросов одним вызовом FAISS."""
+        distances, indices = self.index.search(prepare_queries(query_embeddings, self.meta), top_k)
+        results = []
+        for row in indices:
+            found = [int(i) for i in row if i != -1]
+            if not self.meta.get("id_mapped"):
+                results.append(found)
+            elif self.positions is None:
+                results.append(self.chunks.rows_for_faiss_ids(found))
+            else:
+                results.append([self.positions[i] for i in found if i in self.positions])
+        return results
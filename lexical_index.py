@@ -0,0 +1,108 @@
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Грубый стемминг: у длинных слов оставляем только начало, чтобы
+# "обучение", "обучения" и "обучением" совпадали как один термин
+STEM_LENGTH = 6
+# Константа сглаживания в reciprocal rank fusion
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Разбивает текст на нормализованные термины для лексического поиска."""
+    tokens = TOKEN_PATTERN.findall(text.lower().replace("ё", "е"))
+    return [token[:STEM_LENGTH] if token.isalpha() else token for token in tokens]
+
+
+class BM25Index:
+    """
+    Инвертированный индекс BM25 по текстам чанков.
+
+    Номера документов совпадают с номерами строк в индексе FAISS и в
+    text_chunks.json. Постинги хранятся плоскими массивами NumPy:
+    документы термина `t` лежат в `doc_ids[offsets[t]:offsets[t + 1]]`.
+    """
+
+    def __init__(self, terms: list[str], offsets: np.ndarray, doc_ids: np.ndarray,
+                 term_freqs: np.ndarray, doc_lengths: np.ndarray, build_id: str | None = None):
+        self.build_id = build_id
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        n_docs = len(doc_lengths)
+        doc_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype('float32')
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: list[str]) -> "BM25Index":
+        postings = defaultdict(list)
+        doc_lengths = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths.append(sum(counts.values()))
+            for term, freq in counts.items():
+                postings[term].append((doc_id, freq))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype='int64')
+        doc_ids, term_freqs = [], []
+        for i, term in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+            for doc_id, freq in postings[term]:
+                doc_ids.append(doc_id)
+                term_freqs.append(freq)
+        return cls(terms, offsets, np.array(doc_ids, dtype='int32'),
+                   np.array(term_freqs, dtype='float32'), np.array(doc_lengths, dtype='float32'))
+
+    def search(self, query: str, top_k: int) -> list[tuple[int, float]]:
+        """Возвращает до `top_k` пар (номер чанка, оценка BM25) по убыванию оценки."""
+        scores = np.zeros(len(self.doc_lengths), dtype='float32')
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / self.avg_doc_length)
+            scores[docs] += self.idf[term_id] * freqs * (BM25_K1 + 1) / (freqs + norm)
+
+        candidates = np.flatnonzero(scores)
+        best = candidates[np.argsort(-scores[candidates], kind='stable')[:top_k]]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in best]
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            np.savez(f, terms=np.array(self.terms, dtype=str), offsets=self.offsets,
+                     doc_ids=self.doc_ids, term_freqs=self.term_freqs, doc_lengths=self.doc_lengths,
+                     build_id=np.array(self.build_id or ""))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            return cls(data["terms"].tolist(), data["offsets"], data["doc_ids"],
+                       data["term_freqs"], data["doc_lengths"],
+                       str(data["build_id"]) or None if "build_id" in data else None)
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> list[int]:
+    """Объединяет несколько ранжированных списков документов методом reciprocal rank fusion."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
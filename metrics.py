@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержки, с
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Сколько последних замеров каждой гистограммы хранится для расчета перцентилей
+PERCENTILE_WINDOW = 1000
+PERCENTILES = (50, 95, 99)
+
+# Обработчик, к которому относятся замеры; наследуется задачами asyncio,
+# поэтому запросы к Ollama из планировщика тоже попадают в нужный обработчик
+current_handler = contextvars.ContextVar("current_handler", default="background")
+
+# Поля ответа Ollama с длительностями (в наносекундах) и соответствующие этапы
+OLLAMA_DURATIONS = {
+    "load_duration": "ollama_load",
+    "prompt_eval_duration": "ollama_prompt_eval",
+    "eval_duration": "ollama_eval",
+}
+# Поля ответа Ollama с числом токенов
+OLLAMA_COUNTS = {
+    "prompt_eval_count": "prompt",
+    "eval_count": "eval",
+}
+# Счетчики событий и их описания для экспорта в Prometheus
+COUNTERS = {
+    "semantic_cache_lookups_total": "Обращения к кэшу ответов на похожие вопросы (result: hit — попадание, miss — промах).",
+    "llm_error_replies_total": "Сообщения об ошибке вместо ответа модели (reason: busy, unavailable, error, interrupted, empty).",
+}
+
+
+class Histogram:
+    """Гистограмма с корзинами в формате Prometheus и окном последних замеров для перцентилей."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=PERCENTILE_WINDOW)
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentiles(self) -> list[float]:
+        if not self.recent:
+            return [0.0] * len(PERCENTILES)
+        return [float(p) for p in np.percentile(np.fromiter(self.recent, dtype='float64'), PERCENTILES)]
+
+
+class Metrics:
+    """
+    Замеры задержки по этапам обработки запроса.
+
+    Каждый этап (эмбеддинг, поиск, генерация, отправка ответа) пишется в
+    гистограмму с меткой обработчика. Метрики отдаются в текстовом формате
+    Prometheus и/или периодически выводятся в лог с p50/p95/p99.
+    """
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.tokens: dict[tuple[str, str], int] = defaultdict(int)
+        self.counters: dict[tuple[str, tuple], int] = defaultdict(int)
+
+    def observe(self, stage: str, seconds: float, handler: str | None = None) -> None:
+        self.histograms[(handler or current_handler.get(), stage)].observe(seconds)
+
+    def count(self, name: str, **labels: str) -> None:
+        """Увеличивает счетчик `name` (из COUNTERS) с метками `labels`."""
+        self.counters[(name, tuple(sorted(labels.items())))] += 1
+
+    @contextmanager
+    def span(self, stage: str):
+        """Замеряет время выполнения блока как этап `stage` текущего обработчика."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def instrument(self, func):
+        """Декоратор обработчика: полное время обработки пишется в этап `total`."""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_handler.set(func.__name__)
+            try:
+                with self.span("total"):
+                    return await func(*args, **kwargs)
+            finally:
+                current_handler.reset(token)
+        return wrapper
+
+    def record_ollama_response(self, endpoint: str, data: dict) -> None:
+        """Учитывает статистику, которую Ollama возвращает в итоговом сообщении ответа."""
+        for field, stage in OLLAMA_DURATIONS.items():
+            if data.get(field):
+                self.observe(stage, data[field] / 1e9)
+        for field, kind in OLLAMA_COUNTS.items():
+            if data.get(field):
+                self.tokens[(current_handler.get(), kind)] += int(data[field])
+
+    def summary(self) -> list[str]:
+        lines = []
+        for (handler, stage), histogram in sorted(self.histograms.items()):
+            p50, p95, p99 = histogram.percentiles()
+            lines.append(f"{handler}/{stage}: n={histogram.count} p50={p50:.3f} с p95={p95:.3f} с p99={p99:.3f} с")
+        for (handler, kind), count in sorted(self.tokens.items()):
+            lines.append(f"{handler}/токены {kind}: {count}")
+        for (name, labels), count in sorted(self.counters.items()):
+            lines.append(f"{name}{_render_labels(labels)}: {count}")
+        return lines
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP rag_stage_seconds Время этапов обработки запросов бота.",
+            "# TYPE rag_stage_seconds histogram",
+        ]
+        for (handler, stage), histogram in sorted(self.histograms.items()):
+            labels = f'handler="{handler}",stage="{stage}"'
+            for bound, count in zip(BUCKETS, histogram.bucket_counts):
+                lines.append(f'rag_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'rag_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"rag_stage_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"rag_stage_seconds_count{{{labels}}} {histogram.count}")
+        lines += [
+            "# HELP ollama_tokens_total Токены, обработанные Ollama (prompt — промпт, eval — сгенерированные).",
+            "# TYPE ollama_tokens_total counter",
+        ]
+        for (handler, kind), count in sorted(self.tokens.items()):
+            lines.append(f'ollama_tokens_total{{handler="{handler}",kind="{kind}"}} {count}')
+        for name, description in COUNTERS.items():
+            values = sorted((labels, count) for (counter, labels), count in self.counters.items() if counter == name)
+            if not values:
+                continue
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_render_labels(labels)} {count}" for labels, count in values]
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """Отдает метрики по HTTP в формате Prometheus (на любой путь)."""
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render_prometheus().encode('utf-8')
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                             b"Connection: close\r\n\r\n" + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def log_periodically(self, interval: float) -> None:
+        """Раз в `interval` секунд пишет в лог перцентили задержки по всем этапам."""
+        while True:
+            await asyncio.sleep(interval)
+            if self.histograms:
+                logger.info("Задержки по этапам:\n" + "\n".join(self.summary()))
+
+
+def _render_labels(labels: tuple) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+# Общие метрики процесса бота
+metrics = Metrics()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+# Значения по умолчанию: размер пакета и сколько ждать попутных запросов, с
+MAX_BATCH_SIZE = 16
+MAX_WAIT = 0.005
+
+
+class MicroBatcher(Generic[Item, Result]):
+    """
+    Собирает одиночные запросы, пришедшие почти одновременно, в пакеты.
+
+    Если ни один пакет не выполняется, запрос обрабатывается сразу, без
+    ожидания. Запросы, пришедшие, пока пакет выполняется, копятся и
+    отправляются одним вызовом `process(items)`, когда он завершится, но не
+    позже чем через `max_wait` секунд и не больше `max_batch_size` за раз;
+    `process` должен вернуть результаты в том же порядке. Каждый ожидающий получает свой результат или исключение,
+    если пакет не удалось обработать. Отмена одного ожидающего не влияет на
+    остальных. При `max_batch_size <= 1` или `max_wait <= 0` пакеты не
+    собираются и каждый запрос обрабатывается сразу.
+    """
+
+    def __init__(self, process: Callable[[list[Item]], Awaitable[list[Result]]],
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT, name: str = "batcher"):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._pending: list[tuple[Item, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        # Ссылки на выполняющиеся пакеты, чтобы задачи не собрал сборщик мусора
+        self._running: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1 and self.max_wait > 0
+
+    async def submit(self, item: Item) -> Result:
+        if not self.enabled:
+            return (await self.process([item]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size or not self._running:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        # Запросы, накопившиеся за время выполнения пакета, отправляем не дожидаясь таймера
+        if self._pending and not self._running:
+            self._flush()
+
+    async def _run(self, batch: list[tuple[Item, asyncio.Future]]) -> None:
+        # Запросы, которые уже не ждут (отменены по таймауту), не обрабатываем
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        if len(batch) > 1:
+            logger.debug(f"{self.name}: пакет из {len(batch)} запросов")
+        try:
+            results = await self.process([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"{self.name}: получено {len(results)} результатов на {len(batch)} запросов")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
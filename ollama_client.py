@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import AsyncIterator, Callable
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Общие настройки Ollama для бота, сборки базы знаний и скриптов
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen3:8b")
+
+CONNECT_TIMEOUT = 5
+EMBEDDING_TIMEOUT = 30
+GENERATION_TIMEOUT = 120
+
+# Пул keep-alive соединений, общий для всех диалогов бота
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 60
+
+# Повторы запросов при временных ошибках (нет соединения, 502/503/504, 429)
+MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", "2"))
+RETRY_BACKOFF = 0.5  # Пауза перед первым повтором, с (дальше удваивается)
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+# Если столько запросов подряд не удалось выполнить из-за недоступности Ollama,
+# следующие CIRCUIT_RESET_TIMEOUT секунд запросы сразу завершаются ошибкой
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("OLLAMA_CIRCUIT_FAILURES", "3"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("OLLAMA_CIRCUIT_RESET_TIMEOUT", "30"))
+
+
+class OllamaError(Exception):
+    """Ошибка при обращении к API Ollama (сеть, таймаут, неверный ответ)."""
+
+
+class OllamaUnavailableError(OllamaError):
+    """Ollama недоступен: запрос не отправлялся, потому что разомкнут предохранитель."""
+
+
+def _is_transient(e: Exception) -> bool:
+    """Ошибки, после которых запрос имеет смысл повторить: Ollama не ответил или перегружен."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для недоступного сервиса.
+
+    После `failure_threshold` неудачных запросов подряд размыкается: следующие
+    `reset_timeout` секунд запросы сразу получают OllamaUnavailableError, а не
+    ждут таймаутов. Затем пропускается один пробный запрос; если он успешен,
+    предохранитель замыкается, иначе снова размыкается.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    def before_call(self) -> None:
+        if self.opened_at is None:
+            return
+        if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            raise OllamaUnavailableError("Ollama недоступен, запросы временно не отправляются")
+        self._probing = True
+
+    def release_probe(self) -> None:
+        """Пробный запрос отменен, не дав результата: следующий запрос станет пробным."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Ollama снова доступен.")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(f"Ollama недоступен (неудачных запросов подряд: {self.failures}), "
+                             f"запросы приостановлены на {self.reset_timeout:g} с.")
+            self.opened_at = time.monotonic()
+
+
+def _describe_error(e: Exception) -> str:
+    """Короткое однострочное описание сетевой ошибки для логов."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"HTTP {e.response.status_code} от {e.request.url}"
+    return str(e) or type(e).__name__
+
+
+class AsyncOllamaClient:
+    """
+    Асинхронный клиент Ollama поверх httpx с пулом keep-alive соединений.
+
+    Каждый вызов ограничен собственным таймаутом и может быть отменен
+    через стандартную отмену asyncio-задачи, не блокируя event loop бота.
+    Временные ошибки повторяются с экспоненциальной паузой в пределах того
+    же таймаута, а если Ollama недоступен, предохранитель (CircuitBreaker)
+    заставляет запросы сразу завершаться ошибкой.
+    `response_hook(endpoint, data)` получает итоговый ответ каждого запроса
+    (со статистикой Ollama: eval_count, prompt_eval_duration и т. д.).
+    """
+
+    def __init__(self, base_url: str = OLLAMA_API_URL,
+                 max_connections: int = MAX_CONNECTIONS,
+                 max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+                 response_hook: Callable[[str, dict], None] | None = None,
+                 max_retries: int = MAX_RETRIES, breaker: CircuitBreaker | None = None):
+        self.base_url = base_url
+        self.response_hook = response_hook
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        self._client: httpx.AsyncClient | None = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Клиент создается лениво, чтобы он был привязан к event loop приложения
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=self._limits)
+        return self._client
+
+    async def _with_retries(self, endpoint: str, timeout: float, attempt_call: Callable):
+        """
+        Выполняет `attempt_call(remaining_timeout)` через предохранитель,
+        повторяя его при временных ошибках, пока не истечет общий `timeout`.
+        """
+        self.breaker.before_call()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            for attempt in range(self.max_retries + 1):
+                remaining = deadline - loop.time()
+                try:
+                    result = await asyncio.wait_for(attempt_call(remaining), timeout=remaining)
+                except asyncio.TimeoutError as e:
+                    self.breaker.record_failure()
+                    raise OllamaError(f"превышен таймаут {timeout} с для '{endpoint}'") from e
+                except (httpx.HTTPError, ValueError) as e:
+                    if not _is_transient(e):
+                        # Ollama ответил, но запрос неверный: сервис доступен
+                        self.breaker.record_success()
+                        raise OllamaError(_describe_error(e)) from e
+                    delay = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                    if attempt == self.max_retries or loop.time() + delay >= deadline:
+                        self.breaker.record_failure()
+                        raise OllamaError(_describe_error(e)) from e
+                    logger.warning(f"Ошибка запроса к Ollama '{endpoint}' ({_describe_error(e)}), "
+                                   f"повтор через {delay:.1f} с.")
+                    await asyncio.sleep(delay)
+                else:
+                    self.breaker.record_success()
+                    return result
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+
+    async def _post(self, endpoint: str, payload: dict, timeout: float) -> dict:
+        """POST-запрос к Ollama с общим дедлайном на весь вызов (включая повторы)."""
+        client = self._get_client()
+
+        async def attempt(remaining: float) -> dict:
+            response = await client.post(endpoint, json=payload,
+                                         timeout=httpx.Timeout(remaining, connect=CONNECT_TIMEOUT))
+            response.raise_for_status()
+            return response.json()
+
+        data = await self._with_retries(endpoint, timeout, attempt)
+        if self.response_hook is not None:
+            self.response_hook(endpoint, data)
+        return data
+
+    async def embed_batch(self, texts: list[str], model: str,
+                          timeout: float = EMBEDDING_TIMEOUT, **options) -> np.ndarray:
+        """Возвращает матрицу эмбеддингов для пакета текстов одним запросом к /api/embed."""
+        data = await self._post("embed", {"model": model, "input": texts, **options}, timeout)
+        try:
+            embeddings = np.array(data["embeddings"], dtype='float32')
+        except (KeyError, TypeError, ValueError) as e:
+            raise OllamaError("Не удалось извлечь эмбеддинги из ответа Ollama.") from e
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(texts):
+            raise OllamaError(f"Ollama вернул {len(embeddings)} эмбеддингов вместо {len(texts)}.")
+        return embeddings
+
+    async def chat(self, messages: list[dict], model: str, timeout: float = GENERATION_TIMEOUT,
+                   **options) -> str:
+        """Отвечает на диалог `messages` через /api/chat целиком (без стриминга)."""
+        payload = {"model": model, "messages": messages, "stream": False, **options}
+        data = await self._post("chat", payload, timeout)
+        return (data.get("message") or {}).get("content", "")
+
+    async def chat_stream(self, messages: list[dict], model: str, timeout: float = GENERATION_TIMEOUT,
+                          **options) -> AsyncIterator[str]:
+        """Отвечает на диалог `messages` через /api/chat потоком."""
+        payload = {"model": model, "messages": messages, "stream": True, **options}
+        async for data in self._stream("chat", payload, timeout):
+            content = (data.get("message") or {}).get("content")
+            if content:
+                yield content
+
+    async def _stream(self, endpoint: str, payload: dict, timeout: float) -> AsyncIterator[dict]:
+        """
+        Читает NDJSON-ответ Ollama построчно до сообщения с `done`. Повторяется
+        только установка соединения: после начала ответа ошибка не скрывается.
+        """
+        client = self._get_client()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        async def open_stream(remaining: float) -> httpx.Response:
+            request = client.build_request("POST", endpoint, json=payload,
+                                           timeout=httpx.Timeout(remaining, connect=CONNECT_TIMEOUT))
+            response = await client.send(request, stream=True)
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError:
+                await response.aclose()
+                raise
+            return response
+
+        response = await self._with_retries(endpoint, timeout, open_stream)
+        try:
+            async for line in response.aiter_lines():
+                if loop.time() > deadline:
+                    raise OllamaError(f"превышен таймаут {timeout} с для '{endpoint}'")
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if "error" in data:
+                    raise OllamaError(data["error"])
+                yield data
+                if data.get("done"):
+                    if self.response_hook is not None:
+                        self.response_hook(endpoint, data)
+                    break
+        except (httpx.HTTPError, ValueError) as e:
+            raise OllamaError(_describe_error(e)) from e
+        finally:
+            await response.aclose()
+
+    async def aclose(self) -> None:
+        """Закрывает пул соединений."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,313 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+import numpy as np
+
+from ollama_client import AsyncOllamaClient, OllamaError, EMBEDDING_TIMEOUT, GENERATION_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Виды запросов и их приоритеты (меньше — важнее): короткие запросы
+# эмбеддингов не должны стоять в очереди за долгими генерациями
+EMBED = "embed"
+GENERATE = "generate"
+PRIORITIES = {EMBED: 0, GENERATE: 1}
+
+# Ограничения по умолчанию для одной машины без GPU
+EMBED_CONCURRENCY = 2
+GENERATE_CONCURRENCY = 1
+MAX_CONCURRENCY = 2
+MAX_QUEUE = 20
+# Как часто процесс проверяет, не освободился ли общий для процессов слот, с
+SHARED_SLOT_POLL_INTERVAL = 0.02
+
+QueuedCallback = Callable[[int], Awaitable[None]]
+
+
+class SchedulerBusyError(OllamaError):
+    """Очередь запросов к Ollama переполнена."""
+
+
+class SharedSlots:
+    """
+    Слоты, общие для нескольких процессов (режим webhook): по файлу
+    блокировки на слот в каталоге `directory`. Занятый слот — файл, на
+    который процесс взял flock; при завершении процесса (в том числе
+    аварийном) ОС снимает блокировку, и слот не теряется.
+    """
+
+    def __init__(self, directory: str, name: str, count: int):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"{name}.{i}.lock") for i in range(count)]
+
+    def try_acquire(self) -> int | None:
+        """Занимает свободный слот и возвращает его дескриптор или None, если все заняты."""
+        import fcntl
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    async def acquire(self) -> int:
+        while (fd := self.try_acquire()) is None:
+            await asyncio.sleep(SHARED_SLOT_POLL_INTERVAL)
+        return fd
+
+    @staticmethod
+    def release(fd: int) -> None:
+        # Закрытие дескриптора снимает блокировку
+        os.close(fd)
+
+
+class _Waiter:
+    def __init__(self, kind: str, seq: int, future: asyncio.Future):
+        self.kind = kind
+        self.seq = seq
+        self.future = future
+
+    @property
+    def order(self) -> tuple[int, int]:
+        return PRIORITIES[self.kind], self.seq
+
+
+class _SharedStream:
+    """Поток токенов одной генерации, который читают все запросившие ее пользователи."""
+
+    def __init__(self):
+        self.tokens: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.consumers = 0
+        self.task: asyncio.Task | None = None
+        # Кому сообщить позицию в очереди; позиция известна, пока генерация ждет слот
+        self.on_queued: list[QueuedCallback] = []
+        self.queue_position: int | None = None
+        self.started = False
+        self._updated = asyncio.Event()
+
+    def push(self, token: str) -> None:
+        self.tokens.append(token)
+        self._notify()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def wait(self) -> None:
+        await self._updated.wait()
+
+    async def queued(self, position: int) -> None:
+        """Сообщает позицию в очереди всем, кто уже ждет эту генерацию."""
+        self.queue_position = position
+        for callback in list(self.on_queued):
+            await _notify_queued(callback, position)
+
+    async def join(self, on_queued: QueuedCallback | None) -> None:
+        """Добавляет читателя; если генерация уже стоит в очереди, сразу сообщает ему позицию."""
+        self.consumers += 1
+        if on_queued is None or self.started:
+            return
+        self.on_queued.append(on_queued)
+        if self.queue_position is not None:
+            await _notify_queued(on_queued, self.queue_position)
+
+
+class OllamaScheduler:
+    """
+    Планировщик всех запросов к Ollama.
+
+    Ограничивает число одновременных запросов эмбеддингов и генерации
+    (по отдельности и в сумме), при освобождении слота пропускает вперед
+    эмбеддинги, держит ограниченную очередь с номерами позиций и объединяет
+    одинаковые запросы, которые уже выполняются, в один вызов Ollama.
+    Если задан `shared_dir`, те же ограничения действуют сразу для всех
+    процессов с этим каталогом (см. SharedSlots).
+    """
+
+    def __init__(self, client: AsyncOllamaClient,
+                 embed_concurrency: int = EMBED_CONCURRENCY,
+                 generate_concurrency: int = GENERATE_CONCURRENCY,
+                 max_concurrency: int = MAX_CONCURRENCY,
+                 max_queue: int = MAX_QUEUE,
+                 shared_dir: str | None = None):
+        self.client = client
+        self.limits = {EMBED: embed_concurrency, GENERATE: generate_concurrency}
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._shared = None
+        if shared_dir:
+            self._shared = {EMBED: SharedSlots(shared_dir, EMBED, embed_concurrency),
+                            GENERATE: SharedSlots(shared_dir, GENERATE, generate_concurrency),
+                            "total": SharedSlots(shared_dir, "total", max_concurrency)}
+        self._active = {EMBED: 0, GENERATE: 0}
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._streams: dict[tuple, _SharedStream] = {}
+
+    def _can_start(self, kind: str) -> bool:
+        return (self._active[kind] < self.limits[kind]
+                and sum(self._active.values()) < self.max_concurrency)
+
+    def _dispatch(self) -> None:
+        """Раздает освободившиеся слоты ожидающим в порядке приоритета."""
+        for waiter in sorted(self._waiters, key=lambda w: w.order):
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+            elif self._can_start(waiter.kind):
+                self._active[waiter.kind] += 1
+                waiter.future.set_result(None)
+                self._waiters.remove(waiter)
+
+    @asynccontextmanager
+    async def slot(self, kind: str, on_queued: QueuedCallback | None = None):
+        """Занимает слот для запроса вида `kind`, при необходимости ожидая в очереди."""
+        if self._can_start(kind) and not any(w.kind == kind for w in self._waiters):
+            self._active[kind] += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                raise SchedulerBusyError(f"в очереди к Ollama уже {len(self._waiters)} запросов")
+            waiter = _Waiter(kind, next(self._seq), asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+            # Слот может быть выдан, пока пользователю сообщается позиция, поэтому
+            # отмена в этот момент тоже должна его вернуть
+            try:
+                if on_queued is not None:
+                    await _notify_queued(on_queued, sum(1 for w in self._waiters if w.order <= waiter.order))
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    self._release(kind)
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        try:
+            async with self._shared_slot(kind):
+                yield
+        finally:
+            self._release(kind)
+
+    @asynccontextmanager
+    async def _shared_slot(self, kind: str):
+        """Занимает общий для процессов слот вида `kind` и слот общего лимита (если они заданы)."""
+        if self._shared is None:
+            yield
+            return
+        # Слот общего лимита всегда берется вторым, поэтому процессы не блокируют друг друга
+        fds = []
+        try:
+            for slots in (self._shared[kind], self._shared["total"]):
+                fds.append(await slots.acquire())
+            yield
+        finally:
+            for fd in fds:
+                SharedSlots.release(fd)
+
+    def _release(self, kind: str) -> None:
+        self._active[kind] -= 1
+        self._dispatch()
+
+    async def _dedup(self, key: tuple, factory: Callable[[], Awaitable]):
+        """Выполняет запрос или присоединяется к уже выполняющемуся такому же."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def embed_batch(self, texts: list[str], model: str, timeout: float = EMBEDDING_TIMEOUT,
+                          **options) -> np.ndarray:
+        async def run():
+            async with self.slot(EMBED):
+                return await self.client.embed_batch(texts, model, timeout=timeout, **options)
+        return await self._dedup((EMBED, model, tuple(texts)), run)
+
+    def chat_stream(self, messages: list[dict], model: str, timeout: float = GENERATION_TIMEOUT,
+                    on_queued: QueuedCallback | None = None, **options) -> AsyncIterator[str]:
+        """Потоковый ответ на диалог через /api/chat и очередь (см. `_shared_stream`)."""
+        key = ("chat", model, tuple((m["role"], m["content"]) for m in messages), _options_key(options))
+        return self._shared_stream(
+            key, lambda: self.client.chat_stream(messages, model, timeout=timeout, **options), on_queued)
+
+    async def _shared_stream(self, key: tuple, open_stream: Callable[[], AsyncIterator[str]],
+                             on_queued: QueuedCallback | None) -> AsyncIterator[str]:
+        """
+        Генерация через очередь. Одинаковые запросы (та же модель, промпт
+        и опции) читают один поток: присоединившийся позже сначала
+        получает уже сгенерированные токены, а пока генерация ждет в
+        очереди — позицию в ней через свой `on_queued`.
+        """
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = self._streams[key] = _SharedStream()
+            shared.task = asyncio.ensure_future(self._produce(key, shared, open_stream))
+        position = 0
+        try:
+            await shared.join(on_queued)
+            while True:
+                while position < len(shared.tokens):
+                    yield shared.tokens[position]
+                    position += 1
+                if shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                await shared.wait()
+        finally:
+            shared.consumers -= 1
+            if on_queued in shared.on_queued:
+                shared.on_queued.remove(on_queued)
+            # Если ответ больше никому не нужен, прекращаем генерацию
+            if shared.consumers == 0 and not shared.done:
+                shared.task.cancel()
+
+    async def _produce(self, key: tuple, shared: _SharedStream,
+                       open_stream: Callable[[], AsyncIterator[str]]) -> None:
+        error = None
+        try:
+            async with self.slot(GENERATE, shared.queued):
+                shared.started = True
+                async for token in open_stream():
+                    shared.push(token)
+        except OllamaError as e:
+            error = e
+        except asyncio.CancelledError:
+            error = OllamaError("генерация отменена")
+        finally:
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+            shared.finish(error)
+
+    async def chat(self, messages: list[dict], model: str, timeout: float = GENERATION_TIMEOUT,
+                   on_queued: QueuedCallback | None = None, **options) -> str:
+        """Ответ на диалог целиком; использует тот же общий поток, что и стриминг."""
+        return "".join([token async for token in self.chat_stream(
+            messages, model, timeout=timeout, on_queued=on_queued, **options)])
+
+
+async def _notify_queued(on_queued: QueuedCallback, position: int) -> None:
+    try:
+        await on_queued(position)
+    except Exception as e:
+        logger.warning(f"Не удалось сообщить позицию в очереди: {e}")
+
+
+def _options_key(options: dict) -> str:
+    # Опции могут содержать вложенные словари (например, options={"num_predict": 1})
+    return json.dumps(options, sort_keys=True, ensure_ascii=False)
@@ -1,10 +1,13 @@
+import argparse
+import functools
+import hashlib
+import threading
 import time
 import json
 import os
 import re
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 from bs4 import BeautifulSoup
 
 PROGRAM_URLS = {
@@ -14,76 +17,259 @@ PROGRAM_URLS = {
 DATA_DIR = "data"
 CHUNKS_FILE = os.path.join(DATA_DIR, "text_chunks.json")
 
-def _simple_sentence_split(text):
-    """Надежно разбивает текст на предложения без внешних библиотек."""
-    text = re.sub(r'\. ', '.<SPLIT>', text)
-    text = re.sub(r'\? ', '?<SPLIT>', text)
-    text = re.sub(r'\! ', '!<SPLIT>', text)
-    sentences = text.split('<SPLIT>')
-    return [s.strip() for s in sentences if s and len(s.split()) > 2]
+# Снимки HTML страниц и манифест (manifest.json) с хэшами содержимого и готовыми чанками
+HTML_CACHE_DIR = os.path.join(DATA_DIR, "html_cache")
 
-# --- НОВАЯ ФУНКЦИЯ ДЛЯ УМНОГО СОЗДАНИЯ ЧАНКОВ ---
-def create_sized_chunks(text, min_length=128, max_length=512):
+# Настройки браузеров
+CRAWL_WORKERS = 2  # Сколько экземпляров Chrome рендерят страницы параллельно
+PAGE_READY_TIMEOUT = 20  # Максимальное ожидание готовности страницы, с
+PAGE_READY_SELECTOR = "main h2"  # Страница считается готовой, когда появились заголовки разделов
+
+# Версия разбиения на чанки: при ее смене чанки из кэша снимков пересчитываются
+CHUNKER_VERSION = 2
+
+# Сокращения, после точки в которых предложение не заканчивается (в нижнем регистре, без точки)
+RUSSIAN_ABBREVIATIONS = frozenset("""
+т е н к п д др пр см ср напр г гг в вв руб коп тыс млн млрд трлн ч мин сек
+им ул пр-т корп стр рис табл гл разд пп ст изд акад проф доц канд
+англ рус лат нач зам зав отд ок прим ред сост букв
+""".split())
+
+# Конец предложения — знак препинания перед пробелом. Точка не завершает предложение
+# после сокращения ("тыс. руб. в год", "т. е.") и инициала ("А. С. Пушкин"), а также
+# перед словом с маленькой буквы. Все проверки выполняет одно регулярное выражение.
+SENTENCE_END = re.compile(
+    r"(?:[?!…]|\.(?!\s+[a-zа-яё])"
+    + "".join(rf"(?<!\b(?i:{re.escape(abbreviation)})\.)" for abbreviation in sorted(RUSSIAN_ABBREVIATIONS))
+    + r"(?<!\b[A-ZА-ЯЁ]\.))[.?!…]*(?=\s)"
+)
+
+
+class TextChunk(NamedTuple):
+    """
+    Чанк и его границы в исходном тексте. Текст чанка совпадает с text[start:end],
+    если внутри не было отброшенных обрывков из одного-двух слов.
+    """
+    text: str
+    start: int
+    end: int
+
+
+def split_sentences(text):
+    """
+    Разбивает текст на предложения за один проход регулярного выражения.
+    Возвращает генератор пар (начало, конец) предложений в тексте.
+    """
+    length = len(text)
+    start = length - len(text.lstrip())
+    for match in SENTENCE_END.finditer(text):
+        end = match.end()
+        if end > start:
+            yield start, end
+        start = end + 1
+        while start < length and text[start].isspace():
+            start += 1
+    end = len(text.rstrip())
+    if end > start:
+        yield start, end
+
+
+def iter_chunks(text, min_length=128, max_length=512, overlap=0):
+    """
+    Потоково собирает чанки из предложений текста: предложения добавляются
+    в чанк, пока он не превысит max_length; слишком длинное предложение
+    делится по словам. Чанки короче min_length и предложения из одного-двух
+    слов (обрывки меню и кнопок) отбрасываются. При overlap > 0 каждый
+    следующий чанк начинается с последних предложений предыдущего общей
+    длиной не больше overlap символов.
+    Возвращает генератор TextChunk с позициями чанков в исходном тексте.
+    """
+    sentences = []  # Предложения текущего чанка: (начало, конец)
+    length = 0  # Длина текущего чанка с пробелами между предложениями
+
+    def emit():
+        chunk = " ".join(text[s:e] for s, e in sentences)
+        if len(chunk) >= min_length:
+            return TextChunk(chunk, sentences[0][0], sentences[-1][1])
+        return None
+
+    for span in _bounded_sentences(text, max_length):
+        sentence_len = span[1] - span[0]
+        if sentences and length + 1 + sentence_len > max_length:
+            chunk = emit()
+            if chunk:
+                yield chunk
+            # Перекрытие: переносим хвост предыдущего чанка, если с ним влезет новое предложение
+            kept, kept_length = [], 0
+            for s, e in reversed(sentences):
+                if kept_length + (e - s) + (1 if kept else 0) > overlap:
+                    break
+                kept.insert(0, (s, e))
+                kept_length += (e - s) + (1 if len(kept) > 1 else 0)
+            while kept and kept_length + 1 + sentence_len > max_length:
+                removed = kept.pop(0)
+                kept_length -= (removed[1] - removed[0]) + (1 if kept else 0)
+            sentences, length = kept, kept_length
+        length += sentence_len + (1 if sentences else 0)
+        sentences.append(span)
+
+    if sentences:
+        chunk = emit()
+        if chunk:
+            yield chunk
+
+
+def _bounded_sentences(text, max_length):
+    """Предложения длиннее двух слов; слишком длинные делятся по пробелам на части до max_length."""
+    for start, end in split_sentences(text):
+        if text.count(" ", start, end) < 2:
+            continue
+        while end - start > max_length:
+            cut = text.rfind(" ", start, start + max_length + 1)
+            if cut <= start:
+                cut = start + max_length
+            yield start, cut
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if start < end:
+            yield start, end
+
+
+def create_sized_chunks(text, min_length=128, max_length=512, overlap=0):
     """
     Создает чанки, длина которых находится в заданном диапазоне.
     """
-    sentences = _simple_sentence_split(text)
-    if not sentences:
-        return []
-
-    chunks = []
-    current_chunk_sentences = []
-    current_length = 0
-
-    for sentence in sentences:
-        sentence_len = len(sentence)
-        
-        # Если добавление нового предложения превысит лимит, сохраняем текущий чанк
-        if current_length + sentence_len + (1 if current_chunk_sentences else 0) > max_length:
-            if current_chunk_sentences:
-                chunks.append(" ".join(current_chunk_sentences))
-            current_chunk_sentences = [sentence]
-            current_length = sentence_len
-        else:
-            current_chunk_sentences.append(sentence)
-            current_length += sentence_len + (1 if len(current_chunk_sentences) > 1 else 0)
-    
-    # Добавляем последний оставшийся чанк
-    if current_chunk_sentences:
-        chunks.append(" ".join(current_chunk_sentences))
-
-    # --- Финальный проход для объединения слишком коротких чанков ---
-    final_chunks = []
-    buffer = ""
-    for chunk in chunks:
-        if buffer:
-            potential_buffer = buffer + " " + chunk
-        else:
-            potential_buffer = chunk
-
-        if len(potential_buffer) <= max_length:
-            buffer = potential_buffer
-        else:
-            final_chunks.append(buffer)
-            buffer = chunk
-    
-    if buffer:
-        final_chunks.append(buffer)
-        
-    # Возвращаем только те чанки, которые соответствуют минимальной длине
-    return [c for c in final_chunks if len(c) >= min_length]
+    return [chunk.text for chunk in iter_chunks(text, min_length, max_length, overlap)]
 
 
 def _clean_text(text):
     return re.sub(r'\s+', ' ', text).strip()
 
+# lru_cache не мешает потокам обхода одновременно вызвать функцию в первый раз,
+# поэтому установка chromedriver выполняется под блокировкой
+_chromedriver_lock = threading.Lock()
+
+def _chromedriver_path():
+    """Путь к chromedriver: из CHROMEDRIVER_PATH или через webdriver-manager (один раз за запуск)."""
+    with _chromedriver_lock:
+        return _resolve_chromedriver_path()
+
+@functools.lru_cache(maxsize=1)
+def _resolve_chromedriver_path():
+    if os.getenv("CHROMEDRIVER_PATH"):
+        return os.getenv("CHROMEDRIVER_PATH")
+    from webdriver_manager.chrome import ChromeDriverManager
+    return ChromeDriverManager().install()
+
 def setup_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service as ChromeService
     options = webdriver.ChromeOptions()
     options.add_argument("--headless"); options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage"); options.add_argument("--window-size=1920,1080")
-    service = ChromeService(ChromeDriverManager().install())
+    service = ChromeService(_chromedriver_path())
     return webdriver.Chrome(service=service, options=options)
 
+def wait_until_ready(driver):
+    """Ждет полной загрузки документа и появления контента вместо фиксированной паузы."""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    try:
+        WebDriverWait(driver, PAGE_READY_TIMEOUT).until(
+            lambda d: d.execute_script("return document.readyState") == "complete"
+            and d.find_elements(By.CSS_SELECTOR, PAGE_READY_SELECTOR)
+        )
+    except TimeoutException:
+        print(f"  - Страница {driver.current_url} не дождалась '{PAGE_READY_SELECTOR}' за {PAGE_READY_TIMEOUT} с, берем то, что есть.")
+
+
+class BrowserPool:
+    """Пул headless Chrome: у каждого рабочего потока свой драйвер, создаваемый при первом запросе."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._drivers = []
+        self._lock = threading.Lock()
+
+    def render(self, url):
+        driver = getattr(self._local, "driver", None)
+        if driver is None:
+            driver = self._local.driver = setup_driver()
+            with self._lock:
+                self._drivers.append(driver)
+        driver.get(url)
+        wait_until_ready(driver)
+        return driver.page_source
+
+    def close(self):
+        for driver in self._drivers:
+            driver.quit()
+        self._drivers = []
+
+
+class HtmlSnapshotCache:
+    """
+    Снимки HTML на диске, адресуемые по URL, и хэши их содержимого.
+    Для неизменившейся страницы возвращаются сохраненные чанки без повторного разбора.
+    """
+
+    def __init__(self, cache_dir=HTML_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.manifest_file = os.path.join(cache_dir, "manifest.json")
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+
+    def snapshot_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + ".html")
+
+    def load_html(self, url):
+        try:
+            with open(self.snapshot_path(url), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_chunks(self, url, html):
+        entry = self.manifest.get(url)
+        if entry and entry.get("content_hash") == _content_hash(html) and entry.get("chunker") == CHUNKER_VERSION:
+            return entry.get("chunks")
+        return None
+
+    def put(self, url, html, chunks):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _write_atomic(self.snapshot_path(url), html)
+        self.manifest[url] = {"content_hash": _content_hash(html), "chunker": CHUNKER_VERSION,
+                              "fetched_at": time.time(), "chunks": chunks}
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _write_atomic(self.manifest_file, json.dumps(self.manifest, ensure_ascii=False, indent=4))
+
+def _write_atomic(path, text):
+    """Записывает файл через временный и os.replace, чтобы прерванный обход не оставил его обрезанным."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _content_hash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+def fixtures_fetcher(fixtures_dir):
+    """Источник HTML для офлайн-режима: файлы <ключ программы>.html в каталоге fixtures_dir."""
+    def fetch(key, info):
+        path = os.path.join(fixtures_dir, f"{key}.html")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    return fetch
+
 def parse_page(soup, program_name):
     all_program_chunks = []
     main_container = soup.find('main')
@@ -112,21 +298,66 @@ def parse_page(soup, program_name):
                     
     return all_program_chunks
 
-def main():
-    if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
-    all_chunks = []; driver = setup_driver()
-    try:
-        for key, info in PROGRAM_URLS.items():
+def crawl(programs, fetch_html, cache, workers=CRAWL_WORKERS):
+    """
+    Параллельно получает HTML страниц программ через fetch_html(key, info)
+    и превращает его в чанки. Неизменившиеся страницы не разбираются повторно.
+    """
+    def safe_fetch(item):
+        key, info = item
+        try:
+            return key, info, fetch_html(key, info)
+        except Exception as e:
+            print(f"\n!!! Не удалось загрузить {info['url']}: {e}")
+            return key, info, None
+
+    all_chunks = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, info, html in executor.map(safe_fetch, programs.items()):
             print(f"\n--- Парсинг программы: {info['name']} ---")
-            driver.get(info['url'])
-            time.sleep(5)
-            soup = BeautifulSoup(driver.page_source, 'html.parser')
-            program_chunks = parse_page(soup, info['name'])
-            print(f"  - Собрано и разделено на {len(program_chunks)} фрагментов (длина 128-512 симв.).")
+            if html is None:
+                print("  - HTML страницы недоступен, программа пропущена.")
+                continue
+            program_chunks = cache.get_chunks(info['url'], html)
+            if program_chunks is None:
+                program_chunks = parse_page(BeautifulSoup(html, 'html.parser'), info['name'])
+                cache.put(info['url'], html, program_chunks)
+                print(f"  - Собрано и разделено на {len(program_chunks)} фрагментов (длина 128-512 симв.).")
+            else:
+                print(f"  - Страница не изменилась, используются сохраненные {len(program_chunks)} фрагментов.")
             for i, chunk_text in enumerate(program_chunks):
                 all_chunks.append({"source": info['url'], "program_name": info['name'], "text": chunk_text, "chunk_id": f"{key}_{i}"})
+    cache.save()
+    return all_chunks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сбор текстов страниц программ и разбиение их на чанки.")
+    parser.add_argument("--workers", type=int, default=CRAWL_WORKERS, help="число параллельных браузеров")
+    parser.add_argument("--offline", action="store_true",
+                        help="не запускать браузер, использовать сохраненные снимки HTML из data/html_cache")
+    parser.add_argument("--fixtures", metavar="DIR",
+                        help="не запускать браузер, брать HTML из файлов DIR/<ключ программы>.html")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
+    cache = HtmlSnapshotCache(HTML_CACHE_DIR)
+    pool = None
+    if args.fixtures:
+        fetch_html = fixtures_fetcher(args.fixtures)
+    elif args.offline:
+        fetch_html = lambda key, info: cache.load_html(info['url'])
+    else:
+        pool = BrowserPool()
+        fetch_html = lambda key, info: pool.render(info['url'])
+
+    started = time.perf_counter()
+    try:
+        all_chunks = crawl(PROGRAM_URLS, fetch_html, cache, workers=args.workers)
     finally:
-        driver.quit()
+        if pool: pool.close()
+    print(f"\nОбход {len(PROGRAM_URLS)} страниц занял {time.perf_counter() - started:.1f} с.")
     if not all_chunks: print("\n!!! ОШИБКА: Не удалось собрать данные."); return
     try:
         with open(CHUNKS_FILE, 'w', encoding='utf-8') as f:
@@ -0,0 +1,40 @@
+class PromptTemplate:
+    """
+    Шаблон запроса к чат-модели: неизменная системная часть и шаблон
+    сообщения пользователя с подставляемыми полями.
+
+    Системное сообщение всегда идет первым и не меняется от запроса к запросу,
+    поэтому Ollama может переиспользовать уже посчитанный KV-кэш этого префикса
+    и не тратить время на его повторную обработку.
+    """
+
+    def __init__(self, system: str, user: str):
+        self.system = system.strip()
+        self.user = user.strip()
+
+    def messages(self, **fields) -> list[dict]:
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**fields)},
+        ]
+
+
+# Ответы на вопросы по базе знаний (RAG)
+RAG_PROMPT = PromptTemplate(
+    system="""
+Ты — дружелюбный и экспертный ИИ-ассистент для абитуриентов ИТМО.
+Твоя задача — максимально точно и полно ответить на вопрос пользователя, используя ТОЛЬКО предоставленный контекст.
+Не придумывай информацию. Если в контексте нет прямого ответа, скажи, что не можешь найти точную информацию по этому вопросу в доступных материалах.
+Отвечай структурированно и по делу.
+""",
+    user="""
+КОНТЕКСТ:
+{context}
+
+ВОПРОС:
+{question}
+""",
+)
+
+# Короткое сообщение для прогрева модели: обрабатывается вместе с системной частью
+WARMUP_QUESTION = "Ответь одним словом: готов?"
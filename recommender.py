@@ -1,38 +1,87 @@
-def get_recommendation(background: str) -> str:
+import re
+
+import numpy as np
+
+# Описания программ для текста рекомендации (для программы не из списка выводится только название)
+PROGRAM_DESCRIPTIONS = {
+    "Искусственный интеллект": "Она сфокусирована на глубокой технической подготовке и готовит ML-инженеров и разработчиков AI-систем.",
+    "Управление AI-продуктами": "Она сочетает технические знания с продуктовым менеджментом и нацелена на создание и вывод AI-решений на рынок.",
+}
+
+# Ключевые слова программ для рекомендации без эмбеддингов. Каждое слово — регулярное
+# выражение, которое должно совпасть с целым словом: короткие "ml" или "ba" не находятся
+# внутри "html" или "bank", а "техн\w*" не срабатывает на "тех" в середине слова
+PROGRAM_KEYWORDS = {
+    "Искусственный интеллект": [
+        r"разработчи\w*", r"программист\w*", r"инженер\w*", r"техн\w*", r"developer\w*", r"engineer\w*",
+        r"code", r"coding", r"ml", r"ds", r"data\s+scien\w*",
+    ],
+    "Управление AI-продуктами": [
+        r"менеджер\w*", r"менеджмент\w*", r"продукт\w*", r"проект\w*", r"управл\w*", r"аналитик\w*", r"бизнес\w*",
+        r"manager\w*", r"product\w*", r"project\w*", r"ba",
+    ],
+}
+
+# Если близость бэкграунда к нескольким программам отличается меньше чем на эту
+# величину, рекомендуются все они
+PROFILE_SCORE_MARGIN = 0.02
+
+
+class KeywordMatcher:
+    """Поиск ключевых слов всех программ одним скомпилированным регулярным выражением."""
+
+    def __init__(self, keywords: dict[str, list[str]]):
+        self.names = list(keywords)
+        self.pattern = re.compile(
+            "|".join(rf"(?P<p{i}>\b(?:{'|'.join(words)})\b)" for i, words in enumerate(keywords.values())),
+            re.IGNORECASE,
+        )
+
+    def scores(self, text: str) -> np.ndarray:
+        """1 для программ, ключевые слова которых встретились в тексте, иначе 0."""
+        scores = np.zeros(len(self.names), dtype='float32')
+        for match in self.pattern.finditer(text):
+            scores[int(match.lastgroup[1:])] = 1
+        return scores
+
+
+keyword_matcher = KeywordMatcher(PROGRAM_KEYWORDS)
+
+
+def choose_programs(names: list[str], scores: np.ndarray, margin: float = 0.0) -> list[str]:
+    """Программы с наибольшей оценкой (и те, что отстают от нее не больше чем на margin)."""
+    if not len(scores) or scores.max() <= 0:
+        return []
+    best = scores.max()
+    order = np.argsort(-scores, kind='stable')
+    return [names[i] for i in order if scores[i] >= best - margin]
+
+
+def describe_program(name: str) -> str:
+    return f"**'{name}'**. {PROGRAM_DESCRIPTIONS.get(name, '')}".strip()
+
+
+def format_recommendation(chosen: list[str], all_names: list[str]) -> str:
+    if len(chosen) == 1:
+        return f"Судя по вашему бэкграунду, вам может больше подойти программа {describe_program(chosen[0])}"
+    if chosen:
+        return ("У вас интересный смешанный бэкграунд! Вам могут подойти несколько программ:\n\n"
+                + "\n\n".join(f"— {describe_program(name)}" for name in chosen))
+    return ("Не могу дать однозначную рекомендацию по вашему описанию. Попробуйте подробнее рассказать, "
+            "чем вы занимаетесь и чему хотите научиться.\n\nКоротко о программах:\n\n"
+            + "\n\n".join(f"— {describe_program(name)}" for name in all_names))
+
+
+def get_recommendation(background: str, embedding: np.ndarray | None = None, profiles=None) -> str:
     """
     Возвращает рекомендацию по программе на основе бэкграунда абитуриента.
+
+    Если есть эмбеддинг бэкграунда и профили программ из базы знаний
+    (knowledge_base.ProgramProfiles), программы ранжируются по близости
+    к профилям; иначе — по ключевым словам.
     """
-    background = background.lower()
-    
-    # Ключевые слова для технического бэкграунда
-    tech_keywords = ['разработчик', 'программист', 'инженер', 'тех', 'developer', 'engineer', 'code', 'ml', 'ds']
-    
-    # Ключевые слова для менеджерского/продуктового бэкграунда
-    manager_keywords = ['менеджер', 'продукт', 'проект', 'управл', 'аналитик', 'бизнес', 'manager', 'product', 'project', 'ba']
-
-    is_tech = any(keyword in background for keyword in tech_keywords)
-    is_manager = any(keyword in background for keyword in manager_keywords)
-
-    if is_tech and not is_manager:
-        return (
-            "Судя по вашему бэкграунду, вам может больше подойти программа **'Искусственный интеллект'**. "
-            "Она сфокусирована на глубокой технической подготовке и готовит ML-инженеров и разработчиков AI-систем."
-        )
-    elif is_manager and not is_tech:
-        return (
-            "С вашим опытом в управлении, вам стоит присмотреться к программе **'Управление AI-продуктами'**. "
-            "Она сочетает технические знания с продуктовым менеджментом и нацелена на создание и вывод AI-решений на рынок."
-        )
-    elif is_tech and is_manager:
-        return (
-            "У вас интересный смешанный бэкграунд! Обе программы могут быть вам полезны.\n\n"
-            "Если вы хотите **углубить технические навыки** и заниматься разработкой, выбирайте **'Искусственный интеллект'**.\n\n"
-            "Если же вы хотите **развиваться в сторону управления продуктом**, используя свои технические знания как преимущество, то ваш выбор — **'Управление AI-продуктами'**."
-        )
-    else:
-        return (
-            "Не могу дать однозначную рекомендацию по вашему описанию. Попробуйте описать свой опыт, используя слова "
-            "'разработчик', 'менеджер', 'продукт' или 'инженер', чтобы я мог вам помочь.\n\n"
-            "В целом, если вам ближе код и алгоритмы — это **'Искусственный интеллект'**. "
-            "Если ближе управление, рынок и пользователи — **'Управление AI-продуктами'**."
-        )
+    if embedding is not None and profiles is not None and len(profiles):
+        chosen = choose_programs(profiles.names, profiles.scores(embedding), PROFILE_SCORE_MARGIN)
+        return format_recommendation(chosen, profiles.names)
+    chosen = choose_programs(keyword_matcher.names, keyword_matcher.scores(background))
+    return format_recommendation(chosen, keyword_matcher.names)
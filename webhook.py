@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from urllib.parse import urlparse
+
+from aiohttp import web
+from telegram import Bot, Update
+
+from knowledge_base import DATA_DIR, get_kb_version
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ---- НАСТРОЙКИ ----
+
+# Имя процесса в логе показывает, какой обработчик принял обновление
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+
+# Публичный адрес, на который Telegram присылает обновления (например, https://example.com/telegram).
+# Локальный сервер принимает запросы по тому же пути
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Секрет, который Telegram передает в заголовке каждого запроса (пустой — не проверять)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Как часто проверяется, что процессы-обработчики живы, с
+WORKER_CHECK_INTERVAL = 5
+# Сколько ждать завершения обработчиков при остановке, с
+WORKER_STOP_TIMEOUT = 30
+# Файлы блокировки для общих ограничений запросов к Ollama
+OLLAMA_SLOTS_DIR = os.path.join(DATA_DIR, "ollama_slots")
+
+
+def update_chat_id(data: dict) -> int:
+    """
+    Возвращает id чата из обновления Telegram (в виде JSON), а если чата
+    нет (например, inline-запрос) — id пользователя.
+    """
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return int(chat["id"])
+        user = value.get("from") or value.get("user")
+        if user:
+            return int(user["id"])
+    return 0
+
+
+def worker_settings(number: int) -> dict[str, str]:
+    """
+    Переменные окружения процесса-обработчика. Все обработчики открывают
+    индекс FAISS через mmap и делят ограничения на число запросов к Ollama
+    (через общие файлы блокировки), а очередь ожидания делится между ними
+    поровну. У каждого свой кэш ответов и порт метрик; прогрев моделей и
+    подготовку ответа для сравнения программ выполняет только первый.
+    """
+    max_queue = int(os.getenv("OLLAMA_MAX_QUEUE", "20"))
+    settings = {
+        "FAISS_MMAP": "1",
+        "SEMANTIC_CACHE_PATH": os.path.join(DATA_DIR, f"semantic_cache.worker{number}"),
+        "OLLAMA_SLOTS_DIR": OLLAMA_SLOTS_DIR,
+        "OLLAMA_MAX_QUEUE": str(max(1, max_queue // WEBHOOK_WORKERS)),
+    }
+    if number:
+        settings.update(OLLAMA_WARMUP="0", PRECOMPUTE_ANSWERS="0")
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    if metrics_port:
+        settings["METRICS_PORT"] = str(metrics_port + number)
+    return settings
+
+
+# ---- ПРОЦЕСС-ОБРАБОТЧИК ----
+
+def run_worker(number: int, updates: multiprocessing.Queue, settings: dict[str, str]) -> None:
+    """Точка входа процесса-обработчика: запускает бота без собственного получения обновлений."""
+    # Остановкой обработчиков управляет маршрутизатор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update(settings)
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    import bot
+    if not bot.check_settings():
+        return
+    asyncio.run(serve_updates(bot, number, updates))
+
+
+async def serve_updates(bot, number: int, updates: multiprocessing.Queue) -> None:
+    """Передает приложению бота обновления из очереди, пока не придет None."""
+    application = bot.build_application(polling=False)
+    async with application:
+        # post_init и post_shutdown вызываются только в run_polling/run_webhook
+        await bot.start_background_tasks(application)
+        await application.start()
+        logger.info(f"Обработчик {number} готов к работе.")
+        while (data := await asyncio.to_thread(updates.get)) is not None:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+    await bot.shutdown(application)
+
+
+# ---- МАРШРУТИЗАТОР ----
+
+class UpdateRouter:
+    """
+    Раздает обновления процессам-обработчикам по id чата.
+
+    Все обновления одного чата попадают в один и тот же процесс, поэтому
+    состояние диалогов (ConversationHandler) остается согласованным.
+    Упавший обработчик перезапускается с той же очередью.
+    """
+
+    def __init__(self, workers: int):
+        # spawn: обработчики не наследуют потоки и цикл событий маршрутизатора
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes: list[multiprocessing.Process | None] = [None] * workers
+
+    def start_worker(self, number: int) -> None:
+        process = self.context.Process(target=run_worker, name=f"worker-{number}",
+                                       args=(number, self.queues[number], worker_settings(number)))
+        process.start()
+        self.processes[number] = process
+
+    def start(self) -> None:
+        for number in range(len(self.queues)):
+            self.start_worker(number)
+        logger.info(f"Запущено обработчиков: {len(self.queues)}.")
+
+    def route(self, data: dict) -> int:
+        number = update_chat_id(data) % len(self.queues)
+        self.queues[number].put(data)
+        return number
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for number, process in enumerate(self.processes):
+                if process is not None and process.exitcode is not None:
+                    logger.error(f"Обработчик {number} завершился с кодом {process.exitcode}, перезапускаем.")
+                    self.start_worker(number)
+
+    def stop(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        for number, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Обработчик {number} не завершился за {WORKER_STOP_TIMEOUT} с, останавливаем принудительно.")
+                process.terminate()
+                process.join()
+
+
+def create_app(router: UpdateRouter, path: str) -> web.Application:
+    """HTTP-сервер, принимающий обновления от Telegram."""
+    async def handle_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        router.route(data)
+        return web.Response()
+
+    async def on_startup(app: web.Application) -> None:
+        router.start()
+        app["watch_task"] = asyncio.create_task(router.watch())
+        async with Bot(TELEGRAM_BOT_TOKEN) as telegram_bot:
+            await telegram_bot.set_webhook(WEBHOOK_URL, allowed_updates=Update.ALL_TYPES,
+                                           secret_token=WEBHOOK_SECRET or None)
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+
+    async def on_cleanup(app: web.Application) -> None:
+        app["watch_task"].cancel()
+        await asyncio.to_thread(router.stop)
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main() -> None:
+    """Запуск бота в режиме webhook с несколькими процессами-обработчиками."""
+    if not TELEGRAM_BOT_TOKEN or not WEBHOOK_URL:
+        logger.critical("Для режима webhook нужно задать TELEGRAM_BOT_TOKEN и WEBHOOK_URL.")
+        return
+    if get_kb_version() is None:
+        logger.critical("База знаний не найдена. Запустите parser.py и create_knowledge_base.py.")
+        return
+
+    path = urlparse(WEBHOOK_URL).path or "/"
+    app = create_app(UpdateRouter(WEBHOOK_WORKERS), path)
+    logger.info(f"Прием обновлений на http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{path}")
+    web.run_app(app, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, print=None)
+
+
+if __name__ == '__main__':
+    main()